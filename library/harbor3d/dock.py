@@ -1,12 +1,17 @@
 from dataclasses import dataclass, field
 
 import os
-import struct
+import glob
+import hashlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext, contextmanager
 
 import numpy as np
 
 from .ship import Ship
-from .util import display_util
+from .util import display_util, model_util, load_util, export_util
+from .util.json_util import JsonLoader
 
 from typing import List
 
@@ -14,66 +19,214 @@ from typing import List
 class Dock:
     ships:List[Ship] = field(default_factory=list)
 
+    # key: id(parent ship), value: {id(child ship): child ship}
+    # updated whenever Ship.parent of a ship generated by this dock is assigned
+    children_index:dict = field(default_factory=dict, repr=False, compare=False)
+    # key: name, value: {id(ship): ship}, updated whenever Ship.name is assigned
+    name_index:dict = field(default_factory=dict, repr=False, compare=False)
+    # key: id(ship), value: index in self.ships, rebuilt when the order of ships is changed
+    ship_positions:dict = field(default_factory=dict, repr=False, compare=False)
+    ship_positions_dirty_flag:bool = field(default=False, repr=False, compare=False)
+    # ships edited in a batch, key: id(ship)
+    # dirty flags of their descendants are set once at the end of the batch
+    batch_depth:int = field(default=0, repr=False, compare=False)
+    deferred_parents_dirty_ships:dict = field(default_factory=dict, repr=False, compare=False)
+    deferred_translation_dirty_ships:dict = field(default_factory=dict, repr=False, compare=False)
+
     def clear(self):
         self.ships = []
+        self.children_index = dict()
+        self.name_index = dict()
+        self.ship_positions = dict()
+        self.ship_positions_dirty_flag = False
+        self.deferred_parents_dirty_ships = dict()
+        self.deferred_translation_dirty_ships = dict()
 
     def generate_ship(self):
         ship = Ship()
-
+        ship.dock = self
         self.ships.append(ship)
+        self.name_index.setdefault(ship.name, dict())[id(ship)] = ship
+        if not self.ship_positions_dirty_flag:
+            self.ship_positions[id(ship)] = len(self.ships) - 1
         ship.init_keel()
         return ship
 
-    def get_child_ship(self, parent_ship):
-        childs = []
+    def fetch_children_index(self):
+        return self.children_index
+
+    def rebuild_children_index(self):
+        self.children_index = dict()
         for ship in self.ships:
-            if ship.parent is parent_ship:
-                childs.append(ship)
-        return childs
+            if ship.parent is not None:
+                self.children_index.setdefault(id(ship.parent), dict())[id(ship)] = ship
+
+    def get_child_ship(self, parent_ship):
+        return list(self.fetch_children_index().get(id(parent_ship), dict()).values())
+
+    def iterate_descendants(self, ship):
+        children_index = self.fetch_children_index()
+        stack = list(children_index.get(id(ship), dict()).values())
+        while 0 != len(stack):
+            descendant = stack.pop()
+            yield descendant
+            stack.extend(children_index.get(id(descendant), dict()).values())
+
+    def on_parent_changed(self, ship, former_parent):
+        # called by Ship.parent
+        if former_parent is not None:
+            self.children_index.get(id(former_parent), dict()).pop(id(ship), None)
+        if ship.parent is not None:
+            self.children_index.setdefault(id(ship.parent), dict())[id(ship)] = ship
+        ship.parents_dirty_flag = True
+        ship.translation_dirty_flag = True
+        self.make_parents_dirty_recursively(ship)
+        self.make_translation_dirty_recursively(ship)
+
+    def on_name_changed(self, ship, former_name):
+        # called by Ship.name
+        self.name_index.get(former_name, dict()).pop(id(ship), None)
+        self.name_index.setdefault(ship.name, dict())[id(ship)] = ship
+
+    def fetch_ship_positions(self):
+        if self.ship_positions_dirty_flag:
+            self.ship_positions = {id(ship): index for index, ship in enumerate(self.ships)}
+            self.ship_positions_dirty_flag = False
+        return self.ship_positions
+
+    def set_name(self, ship, name):
+        ship.name = name
+
+    def fetch_by_name(self, name):
+        # in order of self.ships
+        ships = list(self.name_index.get(name, dict()).values())
+        if 1 < len(ships):
+            ship_positions = self.fetch_ship_positions()
+            ships.sort(key=lambda ship: ship_positions[id(ship)])
+        return ships
 
     def rotate_keel(self, ship, y_axis_rotate=0., z_axis_rotate=0.):
         ship.keel.rotation(y_axis_rotate, z_axis_rotate)
         self.make_translation_dirty_recursively(ship)
     
+    def transform_keel(self, ship, translation):
+        ship.keel.set_relative_translation(translation)
+        self.make_translation_dirty_recursively(ship)
+    
     def resize_keel(self, ship, keel_length):
         ship.keel.length = keel_length
+        ship.keel.invalidate_translation()
         self.make_translation_dirty_recursively(ship)
     
     def set_parent(self, ship ,parent, position=1.):
-        ship.set_parent(parent, position)
-        self.make_parents_dirty_recursively(ship)
-        self.make_translation_dirty_recursively(ship)
+        # the descendants are made dirty by Ship.parent if the parent is changed
+        if parent is ship.parent:
+            self.set_parents_position(ship, position)
+        else:
+            self.update_parent(ship, parent, position)
 
     def set_parents_position(self, ship, position=1.):
-        ship.set_parent(ship.parent, position)
+        self.update_parent(ship, ship.parent, position)
         self.make_translation_dirty_recursively(ship)
 
+    def update_parent(self, ship, parent, position):
+        ship.set_parent(parent, position)
+
     def make_parents_dirty_recursively(self, ship):
-        for target_ship in self.ships:
-            for parent in target_ship.parents:
-                if ship is parent:
-                    target_ship.parents_dirty_flag = True
+        if 0 < self.batch_depth:
+            self.deferred_parents_dirty_ships[id(ship)] = ship
+            return
+        for target_ship in self.iterate_descendants(ship):
+            target_ship.parents_dirty_flag = True
 
     def make_translation_dirty_recursively(self, ship):
+        if 0 < self.batch_depth:
+            self.deferred_translation_dirty_ships[id(ship)] = ship
+            return
+        for target_ship in self.iterate_descendants(ship):
+            target_ship.translation_dirty_flag = True
+
+    @contextmanager
+    def batch(self):
+        # edits in the context set dirty flags and sanitize the dock once at the end
+        # depth and ancestors of edited subtrees are not sanitized until then
+        self.batch_depth += 1
+        try:
+            yield self
+        finally:
+            self.batch_depth -= 1
+            if 0 == self.batch_depth:
+                self.apply_deferred_dirty_flags()
+        if 0 == self.batch_depth:
+            self.sanitize_dock()
+
+    def apply_deferred_dirty_flags(self):
+        parents_dirty_ships = self.deferred_parents_dirty_ships
+        translation_dirty_ships = self.deferred_translation_dirty_ships
+        self.deferred_parents_dirty_ships = dict()
+        self.deferred_translation_dirty_ships = dict()
+        for target_ship in self.iterate_union_of_descendants(parents_dirty_ships.values()):
+            target_ship.parents_dirty_flag = True
+        for target_ship in self.iterate_union_of_descendants(translation_dirty_ships.values()):
+            target_ship.translation_dirty_flag = True
+
+    def iterate_union_of_descendants(self, ships):
+        # each descendant is yielded once even if the subtrees overlap
+        children_index = self.fetch_children_index()
+        visited = set()
+        for ship in ships:
+            stack = [ship]
+            while 0 != len(stack):
+                for child in children_index.get(id(stack.pop()), dict()).values():
+                    if not id(child) in visited:
+                        visited.add(id(child))
+                        stack.append(child)
+                        yield child
+
+    def sanitize_parents(self, force=False):
+        if force:
+            self.rebuild_children_index()
+        self.apply_deferred_dirty_flags()
+        if force:
+            for target_ship in self.ships:
+                target_ship.parents_dirty_flag = True
         for target_ship in self.ships:
-            for parent in target_ship.parents:
-                if ship is parent:
-                    target_ship.translation_dirty_flag = True
+            if target_ship.parents_dirty_flag:
+                target_ship.sanitize_ancestry()
 
     def sanitize_dock(self, force=False):
-        for target_ship in reversed(self.ships):
-            if force or target_ship.parents_dirty_flag:
-                target_ship.get_parents()
-        self.ships.sort(key=lambda ship: len(ship.parents))
+        self.sanitize_parents(force)
+        self.ships.sort(key=lambda ship: ship.depth)
+        self.ship_positions_dirty_flag = True # order of ships is changed
 
-        for target_ship in self.ships:
-            if target_ship.parent != None and (force or target_ship.translation_dirty_flag):
-                target_ship.sanitize_keel()
+        self.sanitize_keels([target_ship for target_ship in self.ships \
+            if target_ship.parent != None and (force or target_ship.translation_dirty_flag)])
         
         for target_ship in self.ships:
             if 0 != len(target_ship.subtracts):
                 target_ship.apply_subtructions()
 
+    def sanitize_keels(self, target_ships):
+        # target_ships: sorted by depth
+        # keels of the same depth are sanitized together with stacked matrix products,
+        # parents are always sanitized before their children
+        start = 0
+        while start < len(target_ships):
+            depth = target_ships[start].depth
+            end = start + 1
+            while end < len(target_ships) and depth == target_ships[end].depth:
+                end += 1
+            level_ships = target_ships[start:end]
+            translations_z = np.tile(np.identity(4), (len(level_ships), 1, 1))
+            translations_z[:, 3, 2] = [ship.parent.keel.length * ship.parent_keels_position for ship in level_ships]
+            relative_translations = np.array([ship.parent.keel.relative_translation for ship in level_ships])
+            origin_translations = np.array([ship.parent.keel.origin_translation for ship in level_ships])
+            translations = np.matmul(np.matmul(translations_z, relative_translations), origin_translations)
+            for ship, translation in zip(level_ships, translations):
+                ship.keel.set_start(translation)
+                ship.translation_dirty_flag = False
+            start = end
+
     def start_display(self):
         self.sanitize_dock()
 
@@ -131,12 +284,12 @@ class Dock:
             
         return (right_max, left_max, top_max, bottom_max, front_max, back_max)
 
-    def write_stl(self, f):
+    def write_stl(self, f, precision=None):
         self.sanitize_dock()
         if self.ships is None or len(self.ships) == 0:
             return
         for ship in self.ships:
-            ship.write_stl(f)
+            ship.write_stl(f, precision)
     
     def count_triangles(self):
         count = 0
@@ -145,33 +298,180 @@ class Dock:
             if not ship.is_monocoque():
                 ship.convert_to_monocoque()
             if ship.is_monocoque():
-                count += len(ship.monocoque_shell.triangles)
+                count += ship.monocoque_shell.count_triangles()
         return count
     
-    def write_stl_binary(self, f):
-        # already sanitized and converted to monocoque in method: count_triangles
-        for ship in self.ships:
-            ship.write_stl_binary(f)
+    def write_stl_binary(self, f=None, dir_full_name=None, workers=1, background_io=False, max_queued_blocks=8, array_shell=False):
+        # f: concatinated output, dir_full_name: divided output, both are written in one traversal
+        # the 84-byte header is written to f by this method, callers write nothing before it,
+        # the number of triangles is patched into the header after the triangles are written
+        # workers: number of processes converting ships to monocoque, None: number of cpus, 1: in this process
+        # divided outputs whose content hash is unchanged since the last export are not rewritten,
+        # stl files of the divided output which are not exported this time are deleted
+        # background_io: the encoded triangles of each ship are written by a writer thread in the same order,
+        # at most max_queued_blocks blocks wait to be written
+        # array_shell: converted ships keep ArrayMonocoqueShell, otherwise MonocoqueShell regardless of workers
+        self.sanitize_dock()
+        if f is not None:
+            header_position = f.tell()
+            model_util.write_stl_binary_header(f)
+        previous_hashes = fetch_divided_stl_hashes(dir_full_name)
+        content_hashes = dict()
+        count = 0
+        with export_util.OrderedWriter(background_io, max_queued_blocks) as writer:
+            for ship, file_full_name, content_hash in self.iterate_monocoque_ships(dir_full_name, workers, previous_hashes, array_shell):
+                records = None
+                if f is not None or (file_full_name is not None and content_hash is None):
+                    records = ship.stl_binary_records()
+                if f is not None and records is not None:
+                    writer.submit(f.write, records.tobytes())
+                    count += len(records)
+                if file_full_name is not None:
+                    fname = os.path.basename(file_full_name)
+                    if content_hash is None:
+                        content_hash = calc_stl_binary_content_hash(records)
+                        writer.submit(write_stl_binary_file, file_full_name, records, previous_hashes.get(fname), content_hash)
+                    content_hashes[fname] = content_hash
+        if f is not None:
+            model_util.patch_stl_binary_triangle_count(f, header_position, count)
+        if dir_full_name is not None:
+            delete_orphaned_divided_stl_files(dir_full_name, content_hashes)
+            save_divided_stl_hashes(dir_full_name, content_hashes)
+        return count
     
-    def write_stl_binary_divided(self, dir_full_name):
-        divided_stl_files_count = 0
+    def write_stl_binary_divided(self, dir_full_name, workers=1, background_io=False, array_shell=False):
+        self.write_stl_binary(None, dir_full_name, workers, background_io, array_shell=array_shell)
+
+    def render_stl_binary(self, buffer=None):
+        # return: memoryview of the binary stl
+        # buffer: bytearray or writable memoryview preallocated by the caller, allocated from the number of triangles if None
+        self.sanitize_dock()
+        count = 0
         for ship in self.ships:
             if not ship.is_monocoque():
                 ship.convert_to_monocoque()
-            if ship.is_monocoque():
-                fname = format(divided_stl_files_count, '0>6') + ".stl"
-                if ship.has_name():
-                    fname = ship.name + ".stl"
-                file_full_name = os.path.join(dir_full_name, fname)
-                f = open(file_full_name, "wb")
-                # 80Byte padding
-                for i in range(8):
-                    f.write(struct.pack("xxxxxxxxxx"))
-                
-                # count triangles
-                count = len(ship.monocoque_shell.triangles)
-                f.write(struct.pack("<L", count))
-
-                ship.write_stl_binary(f)
-                f.close()
-                divided_stl_files_count += 1
\ No newline at end of file
+            count += ship.count_stl_triangles()
+        size = load_util.stl_binary_header_size + count * model_util.stl_binary_record_dtype.itemsize
+        if buffer is None:
+            buffer = bytearray(size)
+        view = memoryview(buffer).cast('B')
+        if len(view) < size:
+            raise Exception("buffer is too small: {} < {}".format(len(view), size))
+        view[:80] = bytes(80)
+        view[80:84] = count.to_bytes(4, 'little')
+        offset = load_util.stl_binary_header_size
+        for ship in self.ships:
+            records = ship.stl_binary_records()
+            if records is None or 0 == len(records):
+                continue
+            view[offset:offset+records.nbytes] = records.view(np.uint8)
+            offset += records.nbytes
+        return view[:size]
+
+    def generate_indexed_meshes(self):
+        # [(name, translated vertexes (N, 3), faces (M, 3))], unnamed ships are numbered as divided outputs
+        self.sanitize_dock()
+        meshes = []
+        for index, (ship, _, _) in enumerate(self.iterate_monocoque_ships()):
+            indexed_mesh = ship.indexed_mesh()
+            if indexed_mesh is None:
+                continue
+            name = ship.name if ship.has_name() else format(index, '0>6')
+            meshes.append((name,) + indexed_mesh)
+        return meshes
+
+    def iterate_monocoque_ships(self, dir_full_name=None, workers=1, previous_hashes=None, array_shell=False):
+        # yield (ship, divided output file, content hash if the divided output is already written) in order of ships
+        # ships with ribs are converted (and their divided outputs written) in worker processes,
+        # at most 2 * workers ships are in flight so that converted shells do not pile up
+        # workers send ArrayMonocoqueShell, it is converted to MonocoqueShell unless array_shell
+        with ProcessPoolExecutor(max_workers=workers) if 1 != workers else nullcontext() as executor:
+            max_pending = 2 * (workers if workers is not None else os.cpu_count())
+            pending = deque()
+            divided_stl_files_count = 0
+            for ship in self.ships:
+                if not ship.is_monocoque() and (ship.keel is None or 0 == len(ship.ribs)):
+                    continue
+                file_full_name = None
+                if dir_full_name is not None:
+                    file_full_name = os.path.join(dir_full_name, fetch_divided_stl_file_name(ship, divided_stl_files_count))
+                    divided_stl_files_count += 1
+                future = None
+                if executor is not None and not ship.is_monocoque():
+                    previous_hash = None
+                    if file_full_name is not None and previous_hashes is not None:
+                        previous_hash = previous_hashes.get(os.path.basename(file_full_name))
+                    future = executor.submit(convert_to_monocoque_and_write, ship.keel, ship.ribs, ship.is_visible, file_full_name, previous_hash)
+                pending.append((ship, file_full_name, future))
+                while 0 != len(pending) and (pending[0][2] is None or max_pending <= len(pending)):
+                    yield self.resolve_monocoque_ship(*pending.popleft(), array_shell)
+            while 0 != len(pending):
+                yield self.resolve_monocoque_ship(*pending.popleft(), array_shell)
+
+    def resolve_monocoque_ship(self, ship, file_full_name, future, array_shell=False):
+        if future is None:
+            if not ship.is_monocoque():
+                ship.convert_to_monocoque(array_shell)
+            return ship, file_full_name, None
+        ship.order_ribs()
+        monocoque_shell, content_hash = future.result()
+        ship.monocoque_shell = monocoque_shell if array_shell else monocoque_shell.to_monocoque_shell()
+        return ship, file_full_name, content_hash
+
+def fetch_divided_stl_file_name(ship, divided_stl_files_count):
+    if ship.has_name():
+        return ship.name + ".stl"
+    return format(divided_stl_files_count, '0>6') + ".stl"
+
+def calc_stl_binary_content_hash(records):
+    if records is None:
+        return hashlib.sha256(b"").hexdigest()
+    return hashlib.sha256(records.view(np.uint8)).hexdigest()
+
+def write_stl_binary_file(file_full_name, records, previous_hash=None, content_hash=None):
+    # return: content hash, the file is kept as it is if the hash equals previous_hash
+    data = b"" if records is None else records.tobytes()
+    if content_hash is None:
+        content_hash = calc_stl_binary_content_hash(records)
+    count = 0 if records is None else len(records)
+    if content_hash == previous_hash and os.path.isfile(file_full_name) \
+        and os.path.getsize(file_full_name) == load_util.stl_binary_header_size + len(data):
+        return content_hash
+    with open(file_full_name, "wb") as f:
+        model_util.write_stl_binary_header(f, count)
+        f.write(data)
+    return content_hash
+
+divided_stl_hashes_file_name = ".divided.json"
+
+def fetch_divided_stl_hashes(dir_full_name):
+    # key: file name, value: content hash
+    if dir_full_name is None:
+        return dict()
+    record = JsonLoader(os.path.join(dir_full_name, divided_stl_hashes_file_name))
+    if not os.path.isfile(record.file):
+        return dict()
+    try:
+        return dict(record.fetch()['hashes'])
+    except (ValueError, KeyError, TypeError):
+        return dict() # broken record, everything is rewritten
+
+def save_divided_stl_hashes(dir_full_name, content_hashes):
+    record = JsonLoader(os.path.join(dir_full_name, divided_stl_hashes_file_name))
+    record.dictionary = {'hashes': content_hashes}
+    record.dump()
+
+def delete_orphaned_divided_stl_files(dir_full_name, content_hashes):
+    # only stl files are deleted, the other files (e.g. caches) are left
+    for file_full_name in glob.glob(os.path.join(dir_full_name, "*.stl")):
+        if not os.path.basename(file_full_name) in content_hashes:
+            os.remove(file_full_name)
+
+def convert_to_monocoque_and_write(keel, ribs, is_visible, file_full_name, previous_hash=None):
+    # runs in a worker process, the ship is rebuilt without its parents (keel is already sanitized)
+    ship = Ship(keel=keel, ribs=ribs, is_visible=is_visible)
+    ship.convert_to_monocoque(array_shell=True)
+    content_hash = None
+    if file_full_name is not None:
+        content_hash = write_stl_binary_file(file_full_name, ship.stl_binary_records(), previous_hash)
+    return ship.monocoque_shell, content_hash
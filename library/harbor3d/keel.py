@@ -14,6 +14,12 @@ class Keel():
     length: float = field(default=1.)
     relative_translation: np.ndarray = field(default=None)
     origin_translation: np.ndarray = field(default=None)
+    # (relative_translation, origin_translation, world translation) of the last call of world_translation
+    world_translation_cache: tuple = field(default=None, repr=False, compare=False)
+    # key: position, value: translation(position), valid while translation_cache_stamp is unchanged
+    translation_cache: dict = field(default_factory=dict, repr=False, compare=False)
+    translation_cache_stamp: tuple = field(default=None, repr=False, compare=False)
+    translation_cache_max_size = 256
 
     def __post_init__(self):
         self.relative_translation = np.array(self.translation_unit)
@@ -22,30 +28,85 @@ class Keel():
     def set_length(self, length):
         self.length = length
         self.end = np.array([0., 0., length, 1.])
+        self.invalidate_translation()
 
         return self
 
     def rotation(self, y_axis_rotate=0., z_axis_rotate=0.):
-        y_rotate = np.array([\
+        self.relative_translation = np.dot(Keel.rotation_matrix_y(y_axis_rotate), Keel.rotation_matrix_z(z_axis_rotate))
+        self.invalidate_translation()
+
+        return self
+
+    def set_relative_translation(self, translation):
+        # arbitrary 4x4 affine matrix (row vector convention), replaces the rotation
+        self.relative_translation = np.array(translation, dtype=np.float64)
+        self.invalidate_translation()
+
+        return self
+
+    @staticmethod
+    def translation_matrix(x=0., y=0., z=0.):
+        return np.array([\
+            [1., 0., 0., 0.],\
+            [0., 1., 0., 0.],\
+            [0., 0., 1., 0.],\
+            [x, y, z, 1.]])
+
+    @staticmethod
+    def rotation_matrix_x(x_axis_rotate):
+        return np.array([\
+            [1., 0., 0., 0.],\
+            [0., np.cos(x_axis_rotate), np.sin(x_axis_rotate), 0.],\
+            [0., -np.sin(x_axis_rotate), np.cos(x_axis_rotate), 0.],\
+            [0., 0., 0., 1.]])
+
+    @staticmethod
+    def rotation_matrix_y(y_axis_rotate):
+        return np.array([\
             [np.cos(y_axis_rotate), 0., -np.sin(y_axis_rotate), 0.],\
             [0., 1., 0., 0.],\
             [np.sin(y_axis_rotate), 0., np.cos(y_axis_rotate), 0.],\
             [0., 0., 0., 1.]])
-        z_rotate = np.array([\
+
+    @staticmethod
+    def rotation_matrix_z(z_axis_rotate):
+        return np.array([\
             [np.cos(z_axis_rotate), np.sin(z_axis_rotate), 0., 0.],\
             [-np.sin(z_axis_rotate), np.cos(z_axis_rotate), 0., 0.],\
             [0., 0., 1., 0.],\
             [0., 0., 0., 1.]])
 
-        self.relative_translation = np.dot(y_rotate, z_rotate)
-
-        return self
+    def world_translation(self):
+        # relative_translation dot origin_translation, recalculated only after either of them is replaced
+        cache = self.world_translation_cache
+        if cache is None or cache[0] is not self.relative_translation or cache[1] is not self.origin_translation:
+            cache = (self.relative_translation, self.origin_translation, np.dot(self.relative_translation, self.origin_translation))
+            self.world_translation_cache = cache
+        return cache[2]
 
     def translation(self, position):
-        return np.dot(np.dot(self.translation_z(position), self.relative_translation), self.origin_translation)
+        # the returned matrix is shared by the following calls, do not modify it
+        stamp = self.translation_cache_stamp
+        if stamp is None or stamp[0] != self.length \
+            or stamp[1] is not self.relative_translation or stamp[2] is not self.origin_translation:
+            # length, relative_translation or origin_translation is replaced without the setters
+            self.invalidate_translation()
+        translation = self.translation_cache.get(position)
+        if translation is None:
+            if self.translation_cache_max_size <= len(self.translation_cache):
+                self.translation_cache.clear()
+            translation = np.dot(np.dot(self.translation_z(position), self.relative_translation), self.origin_translation)
+            self.translation_cache[position] = translation
+        return translation
+
+    def invalidate_translation(self):
+        self.translation_cache = dict()
+        self.translation_cache_stamp = (self.length, self.relative_translation, self.origin_translation)
 
     def set_start(self, translation):
         self.origin_translation = translation
+        self.invalidate_translation()
 
         return self
     
@@ -4,7 +4,7 @@ import numpy as np
 
 from typing import List
 
-from .util import EndSurface, Facet, Position, Triangle
+from .util import EndSurface, Position, Triangle
 
 @dataclass
 class Rib:
@@ -12,42 +12,41 @@ class Rib:
     edges: list = field(default_factory=list)
     position: float = field(default=0.)
     
-    def write_stl_beam(self, keel, former_rib_edges, is_former_rib_clockwise, f):
-        edges_count = len(self.edges)
+    def generate_stl_beam_vertexes(self, keel, former_rib_edges, is_former_rib_clockwise, triangle_vertexes):
+        # triangle_vertexes: list of (M, 3, 3) arrays, the facets to the former rib are appended
         if self.edges is None:
             return None
-        return_edges = []
-        for edge in self.edges:
-            translated_edge = np.dot(np.array([edge[0], edge[1], 0., 1.]), keel.translation(self.position))
-            return_edges.append(translated_edge)
+        return_edges = self.translate_edges(keel)
         is_rib_clockwise = EndSurface().rib_to_vectors(self).is_clockwise
         if former_rib_edges is not None \
             and len(former_rib_edges) != 0 \
             and len(return_edges) != 0:
-            Rib.write_stl_inter_edges(former_rib_edges, is_former_rib_clockwise, return_edges, is_rib_clockwise, f)
+            triangle_vertexes.append(
+                Rib.generate_stl_inter_edges_vertexes(former_rib_edges, is_former_rib_clockwise, return_edges, is_rib_clockwise))
         return return_edges, is_rib_clockwise
 
-    def write_stl_start(self, keel, f):
-        edges_count = len(self.edges)
-        if edges_count <= 2:
-            return
-        else:
-            facets = EndSurface().rib_to_vectors(self).generate_facets(is_start_side=True)
-            for facet in facets:
-                facet.translation(keel.translation(self.position))
-                facet.calc_normal()
-                facet.write(f)
+    def translate_edges(self, keel):
+        # return: (N, 4) positions of the edges in the world
+        edges = np.zeros((len(self.edges), 4))
+        edges[:, :2] = self.edges
+        edges[:, 3] = 1.
+        return np.dot(edges, keel.translation(self.position))
+
+    def generate_stl_start_vertexes(self, keel):
+        return self.generate_stl_end_surface_vertexes(keel, is_start_side=True)
 
-    def write_stl_end(self, keel, f):
+    def generate_stl_end_vertexes(self, keel):
+        return self.generate_stl_end_surface_vertexes(keel, is_start_side=False)
+
+    def generate_stl_end_surface_vertexes(self, keel, is_start_side):
         edges_count = len(self.edges)
         if edges_count <= 2:
-            return
-        else:
-            facets = EndSurface().rib_to_vectors(self).generate_facets(is_start_side=False)
-            for facet in facets:
-                facet.translation(keel.translation(self.position))
-                facet.calc_normal()
-                facet.write(f)
+            return np.zeros((0, 3, 3))
+        facets = EndSurface().rib_to_vectors(self).generate_facets(is_start_side)
+        if 0 == len(facets):
+            return np.zeros((0, 3, 3))
+        vertexes = np.array([[facet.vertex_1, facet.vertex_2, facet.vertex_3] for facet in facets])
+        return np.dot(vertexes, keel.translation(self.position))[:, :, :3]
     
     def generate_monocoque_shells_beam(
         self, monocoque_shell, keel, former_rib_positions, is_former_rib_clockwise, end_rib_positions):
@@ -84,45 +83,32 @@ class Rib:
                 monocoque_shell, z_position, is_start_side=False)
     
     @staticmethod
-    def write_stl_inter_edges(former_rib_edges, is_former_rib_clockwise, edges, is_rib_clockwise, f):
+    def generate_stl_inter_edges_vertexes(former_rib_edges, is_former_rib_clockwise, edges, is_rib_clockwise):
+        # return: (M, 3, 3) vertexes of the facets between two ribs
+        # edges: translated (N, 4) positions
         if len(edges) == 1 and len(former_rib_edges) == 1:
-            return
+            return np.zeros((0, 3, 3))
+        edges = np.asarray(edges)[:, :3]
+        former_rib_edges = np.asarray(former_rib_edges)[:, :3]
         edges_count = len(edges) if len(edges) >= len(former_rib_edges) else len(former_rib_edges)
         is_clockwise = is_rib_clockwise if len(edges) != 1 else is_former_rib_clockwise
+        i = np.arange(edges_count)
+        # negative indexes are the same as edges[i-1] at i == 0
+        former_rib_indexes = (i-1)//(edges_count//len(former_rib_edges))
+        edges_indexes = i//(edges_count//len(edges))
+        facets = []
         if is_clockwise:
-            for i in range(edges_count):
-                if len(edges) != 1:
-                    facet = Facet()
-                    facet.vertex_1 = edges[i]
-                    facet.vertex_2 = former_rib_edges[(i-1)//(edges_count//len(former_rib_edges))]#i==0の時も成立
-                    facet.vertex_3 = edges[i-1]
-                    facet.calc_normal()
-                    facet.write(f)
-
-                if len(former_rib_edges) != 1:
-                    facet = Facet()
-                    facet.vertex_1 = edges[i//(edges_count//len(edges))]
-                    facet.vertex_2 = former_rib_edges[i]
-                    facet.vertex_3 = former_rib_edges[i-1]
-                    facet.calc_normal()
-                    facet.write(f)
+            if len(edges) != 1:
+                facets.append(np.stack([edges[i], former_rib_edges[former_rib_indexes], edges[i-1]], axis=1))
+            if len(former_rib_edges) != 1:
+                facets.append(np.stack([edges[edges_indexes], former_rib_edges[i], former_rib_edges[i-1]], axis=1))
         else:
-            for i in range(edges_count):
-                if len(former_rib_edges) != 1:
-                    facet = Facet()
-                    facet.vertex_1 = edges[i]
-                    facet.vertex_2 = edges[i-1]
-                    facet.vertex_3 = former_rib_edges[(i-1)//(edges_count//len(former_rib_edges))]#i==0の時も成立
-                    facet.calc_normal()
-                    facet.write(f)
-
-                if len(edges) != 1:
-                    facet = Facet()
-                    facet.vertex_1 = edges[i//(edges_count//len(edges))]
-                    facet.vertex_2 = former_rib_edges[i-1]
-                    facet.vertex_3 = former_rib_edges[i]
-                    facet.calc_normal()
-                    facet.write(f)
+            if len(former_rib_edges) != 1:
+                facets.append(np.stack([edges[i], edges[i-1], former_rib_edges[former_rib_indexes]], axis=1))
+            if len(edges) != 1:
+                facets.append(np.stack([edges[edges_indexes], former_rib_edges[i-1], former_rib_edges[i]], axis=1))
+        # two facets for each i in turn
+        return np.stack(facets, axis=1).reshape(-1, 3, 3)
     
     @staticmethod
     def generate_monocoque_inter_positions(former_rib_positions, is_former_rib_clockwise, positions, is_rib_clockwise):
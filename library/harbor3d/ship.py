@@ -4,18 +4,19 @@ import numpy as np
 
 from .keel import Keel
 from .rib import Rib
-from .util import EndSurface, MonocoqueShell
+from .util import EndSurface, MonocoqueShell, ArrayMonocoqueShell
 from .util import calc_util, model_util, load_util, load_rib_from_bmp_util, edges_util
 
 from typing import List, Any
-from functools import reduce
 
 @dataclass
 class Ship:
     keel:Keel = field(default=None)
     ribs:List[Rib] = field(default_factory=list)
     parent:any = field(default=None)
-    parents:List[Any] = field(default_factory=list)
+    # number of ancestors and [parent, 2nd ancestor, 4th ancestor, ...] for binary lifting
+    depth:int = field(default=0)
+    ancestor_jumps:List[Any] = field(default_factory=list, repr=False)
     parents_dirty_flag:bool = field(default=False)
     translation_dirty_flag:bool = field(default=False)
     parent_keels_position:float =  field(default=1.)
@@ -33,6 +34,9 @@ class Ship:
 
     is_visible:bool = field(default=True)
 
+    # dock which generated this ship, notified when parent or name is assigned
+    dock:Any = field(default=None, repr=False, compare=False)
+
     def length(self):
         return self.keel.length()
 
@@ -43,24 +47,72 @@ class Ship:
         self.parent_keels_position = position
         self.parent = parent
         self.sanitize_keel()
-        self.parents = []
-        self.get_parents()
+        self.sanitize_ancestry()
         return self
 
-    def get_parents(self):
+    def sanitize_ancestry(self):
+        # dirty parents are sanitized first
+        chain = [self]
+        while chain[-1].parent is not None and chain[-1].parent.parents_dirty_flag:
+            chain.append(chain[-1].parent)
+        for ship in reversed(chain):
+            ship.update_ancestor_jumps()
+
+    def update_ancestor_jumps(self):
         self.parents_dirty_flag = False
-        if self.parent == None:
-            return []
-        self.parents = []
-        self.parents.extend(self.parent.get_parents())
-        self.parents.append(self.parent)
+        if self.parent is None:
+            self.depth = 0
+            self.ancestor_jumps = []
+            return
+        self.depth = self.parent.depth + 1
+        # the 2^k th ancestor is the 2^(k-1) th ancestor of the 2^(k-1) th ancestor
+        ancestor_jumps = [self.parent]
+        while len(ancestor_jumps) <= len(ancestor_jumps[-1].ancestor_jumps):
+            ancestor_jumps.append(ancestor_jumps[-1].ancestor_jumps[len(ancestor_jumps)-1])
+        self.ancestor_jumps = ancestor_jumps
+
+    def fetch_ancestor(self, depth):
+        # ancestor at the depth (self if depth == self.depth), None if depth is out of range
+        if depth < 0 or self.depth < depth:
+            return None
+        ship = self
+        distance = self.depth - depth
+        k = 0
+        while 0 != distance:
+            if distance & 1:
+                ship = ship.ancestor_jumps[k]
+            distance >>= 1
+            k += 1
+        return ship
+
+    def fetch_lowest_common_ancestor(self, other):
+        # the deepest ship which is self or an ancestor of self, and other or an ancestor of other
+        ship = self.fetch_ancestor(min(self.depth, other.depth))
+        other = other.fetch_ancestor(min(self.depth, other.depth))
+        if ship is other:
+            return ship
+        for k in reversed(range(len(ship.ancestor_jumps))):
+            if k < len(ship.ancestor_jumps) and ship.ancestor_jumps[k] is not other.ancestor_jumps[k]:
+                ship = ship.ancestor_jumps[k]
+                other = other.ancestor_jumps[k]
+        return ship.parent if ship.parent is other.parent else None
+
+    @property
+    def parents(self):
+        # ancestors from the root to the parent, generated on each access
+        parents = []
+        ship = self.parent
+        while ship is not None:
+            parents.append(ship)
+            ship = ship.parent
+        parents.reverse()
+        return parents
+
+    def get_parents(self):
         return self.parents
     
     def is_contains_in_parents(self, target_ship):
-        for ship in self.parents:
-            if ship is target_ship:
-                return True
-        return False
+        return target_ship.depth < self.depth and self.fetch_ancestor(target_ship.depth) is target_ship
 
     def end(self, child):
         child.end = self
@@ -71,59 +123,85 @@ class Ship:
             return None
         return self.keel.end - self.keel.start
 
-    def write_stl(self, f):
+    def write_stl(self, f, precision=None):
         if not self.is_visible:
             return
         if self.keel is None:
             return
         if None != self.monocoque_shell:
-            self.monocoque_shell.write_stl(self.keel, f)
+            self.monocoque_shell.write_stl(self.keel, f, precision)
             return
+        model_util.write_stl_triangle_vertexes(self.generate_rib_stl_triangle_vertexes(), f, precision)
+
+    def generate_rib_stl_triangle_vertexes(self):
+        # return: (M, 3, 3) vertexes of the facets generated from the ribs
+        triangle_vertexes = []
         if self.smoothing:
             if self.smoothing_from is None\
                 or self.smoothing_from.ribs is None or len(self.smoothing_from.ribs) == 0\
                 or self.smoothing_to is None\
                 or self.smoothing_to.ribs is None or len(self.smoothing_to.ribs) == 0:
-                return
+                return np.zeros((0, 3, 3))
             rib_from = self.get_rib_end(self.smoothing_from)
-            translated_edges_from = []
-            for edge in rib_from.edges:
-                translated_edge_from = np.dot(np.array([edge[0], edge[1], 0., 1.]), self.smoothing_from.keel.translation(rib_from.position))
-                translated_edges_from.append(translated_edge_from)
+            translated_edges_from = rib_from.translate_edges(self.smoothing_from.keel)
 
             rib_to = self.get_rib_start(self.smoothing_to)
-            translated_edges_to = []
-            for edge in rib_to.edges:
-                translated_edge_to = np.dot(np.array([edge[0], edge[1], 0., 1.]), self.smoothing_to.keel.translation(rib_to.position))
-                translated_edges_to.append(translated_edge_to)
+            translated_edges_to = rib_to.translate_edges(self.smoothing_to.keel)
             
             end_surface_from = EndSurface().rib_to_vectors(rib_from)
             end_surface_to = EndSurface().rib_to_vectors(rib_to)
-            Rib.write_stl_inter_edges(translated_edges_from, end_surface_from.is_clockwise, translated_edges_to, end_surface_to.is_clockwise, f)
+            triangle_vertexes.append(Rib.generate_stl_inter_edges_vertexes(
+                translated_edges_from, end_surface_from.is_clockwise, translated_edges_to, end_surface_to.is_clockwise))
         else:
             if len(self.ribs) == 0:
-                return
+                return np.zeros((0, 3, 3))
             rib_start = self.get_rib_start(self)
-            rib_start.write_stl_start(self.keel, f)
+            triangle_vertexes.append(rib_start.generate_stl_start_vertexes(self.keel))
             rib_end = self.get_rib_end(self)
-            rib_end.write_stl_end(self.keel, f)
+            triangle_vertexes.append(rib_end.generate_stl_end_vertexes(self.keel))
             former_rib_edges = None
             is_former_rib_clockwise = True
             for rib in self.ribs:
-                former_rib_info = rib.write_stl_beam(self.keel, former_rib_edges, is_former_rib_clockwise, f)
+                former_rib_info = rib.generate_stl_beam_vertexes(self.keel, former_rib_edges, is_former_rib_clockwise, triangle_vertexes)
                 if former_rib_info != None:
                     former_rib_edges, is_former_rib_clockwise = former_rib_info
+        return np.concatenate(triangle_vertexes)
 
-    def write_stl_binary(self, f):
+    def stl_binary_records(self):
         # possible to think only about the monocoque shell
         if not self.is_visible:
-            return
+            return None
         if self.keel is None:
-            return
+            return None
         if not self.is_monocoque():
-            return
-        self.monocoque_shell.write_stl_binary(self.keel, f)
+            return None
+        return self.monocoque_shell.stl_binary_records(self.keel)
+
+    def count_stl_triangles(self):
+        # number of records returned by stl_binary_records
+        if not self.is_visible or self.keel is None or not self.is_monocoque():
+            return 0
+        if self.is_array_monocoque():
+            return self.monocoque_shell.count_triangles()
+        return sum(1 for triangle in self.monocoque_shell.triangles \
+            if triangle.vertex_1 is not None and triangle.vertex_2 is not None and triangle.vertex_3 is not None)
+
+    def indexed_mesh(self):
+        # (translated vertexes (N, 3), faces (M, 3)), each position of the shell is written once
+        if not self.is_visible:
+            return None
+        if self.keel is None:
+            return None
+        if not self.is_monocoque():
+            return None
+        array_shell = self.monocoque_shell
+        if not self.is_array_monocoque():
+            array_shell = ArrayMonocoqueShell.from_monocoque_shell(self.monocoque_shell)
+        return array_shell.translated_vertexes(self.world_translation()), array_shell.faces
     
+    def world_translation(self):
+        return self.keel.world_translation()
+
     def init_keel(self):
         self.keel = Keel()
         return self.keel
@@ -173,13 +251,19 @@ class Ship:
                 rib_start = rib
         return rib_start
 
-    def load_stl(self, path, vertex_matching=False):
-        self.monocoque_shell = load_util.load_binary_stl(path, vertex_matching)
+    def load_stl(self, path, vertex_matching=False, array_shell=False, weld_cache=None, tolerance=0.):
+        if array_shell:
+            self.monocoque_shell = load_util.load_binary_stl_array(path, vertex_matching, weld_cache, tolerance)
+        else:
+            self.monocoque_shell = load_util.load_binary_stl(path, vertex_matching, weld_cache, tolerance)
     
-    def load_huge_binary_stl(self, path):
-        self.monocoque_shell = load_util.load_huge_binary_stl(path)
+    def load_huge_binary_stl(self, path, array_shell=False, tolerance=0.):
+        if array_shell:
+            self.monocoque_shell = load_util.map_binary_stl(path).array_monocoque_shell(tolerance=tolerance)
+        else:
+            self.monocoque_shell = load_util.load_huge_binary_stl(path, tolerance)
 
-    def convert_to_monocoque(self):
+    def convert_to_monocoque(self, array_shell=False):
         if self.keel is None:
             return
         # smoothingへは未対応
@@ -208,10 +292,19 @@ class Ship:
                 self.monocoque_shell, self.keel, former_rib_positions, is_former_rib_clockwise, positions_end)
             if former_rib_info != None:
                 former_rib_positions, is_former_rib_clockwise = former_rib_info
+        if array_shell:
+            self.monocoque_shell = ArrayMonocoqueShell.from_monocoque_shell(self.monocoque_shell)
     
     def is_monocoque(self):
         return None != self.monocoque_shell
 
+    def is_array_monocoque(self):
+        return isinstance(self.monocoque_shell, ArrayMonocoqueShell)
+
+    def convert_monocoque_to_objects(self):
+        if self.is_array_monocoque():
+            self.monocoque_shell = self.monocoque_shell.to_monocoque_shell()
+
     def align_keel_size_to_monocoque_shell(self):
         self.keel.length = self.monocoque_shell_max_z_position
         return self
@@ -219,20 +312,23 @@ class Ship:
     def apply_subtructions(self):
         if not self.is_monocoque():
             self.convert_to_monocoque()
+        self.convert_monocoque_to_objects()
         for subtract_ship in self.subtracts:
             subtract_ship.is_visible = False
             if not subtract_ship.is_monocoque():
                 subtract_ship.convert_to_monocoque()
+            subtract_ship.convert_monocoque_to_objects()
             relative_translation = subtract_ship.keel.relative_translation.copy()
-            if not reduce(lambda x, y: x or y, map(lambda x: x is self, subtract_ship.parents)):
+            if not subtract_ship.is_contains_in_parents(self):
                 relative_translation_to_self = self.keel.relative_translation.copy()
-                common_ancestors = [x for x in self.parents if any(x is y for y in subtract_ship.parents)]
-                if 0 == len(common_ancestors):
+                # the deepest ancestor common to both ships
+                common_ancestor = self.fetch_lowest_common_ancestor(subtract_ship)
+                if common_ancestor is subtract_ship:
+                    common_ancestor = common_ancestor.parent
+                if common_ancestor is None:
                     self.calc_relative_translation_to_ancestor(subtract_ship, None, relative_translation)
                     self.calc_relative_translation_to_ancestor(self, None, relative_translation_to_self)
                 else:
-                    common_ancestors.sort(key=lambda ship: len(ship.parents))
-                    common_ancestor = common_ancestors[-1]
                     self.calc_relative_translation_to_ancestor(subtract_ship, common_ancestor, relative_translation)
                     self.calc_relative_translation_to_ancestor(self, common_ancestor, relative_translation_to_self)
                 relative_translation = np.dot(relative_translation, np.linalg.inv(relative_translation_to_self))
@@ -341,3 +437,27 @@ class Ship:
         for self_triangle in self.monocoque_shell.triangles:
             triangles_set.add(self_triangle)
         self.monocoque_shell.triangles = list(triangles_set)
+
+# parent and name are properties so that the dock keeps its children and name indexes whichever way they are assigned
+def get_ship_parent(ship):
+    return ship.__dict__.get('parent')
+
+def set_ship_parent(ship, parent):
+    former_parent = ship.__dict__.get('parent')
+    ship.__dict__['parent'] = parent
+    dock = ship.__dict__.get('dock')
+    if dock is not None and former_parent is not parent:
+        dock.on_parent_changed(ship, former_parent)
+
+def get_ship_name(ship):
+    return ship.__dict__.get('name')
+
+def set_ship_name(ship, name):
+    former_name = ship.__dict__.get('name')
+    ship.__dict__['name'] = name
+    dock = ship.__dict__.get('dock')
+    if dock is not None and former_name != name:
+        dock.on_name_changed(ship, former_name)
+
+Ship.parent = property(get_ship_parent, set_ship_parent)
+Ship.name = property(get_ship_name, set_ship_name)
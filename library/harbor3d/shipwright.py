@@ -1,16 +1,18 @@
 from dataclasses import dataclass, field
-import struct
 import numpy as np
 import os
 import shutil
 
 from .ship import Ship
 from .dock import Dock
+from .keel import Keel
 from .specification import Spec
 
 from .util import load_util
 from .util.bone_json_util import PostureWrapper, BoneKeys, BoneAxisValue
 from .util import edges_util
+from .util import export_util
+from .util import model_util
 
 @dataclass
 class Shipwright:
@@ -19,12 +21,17 @@ class Shipwright:
     cached_parent_position:float = field(default=1.)
     cached_rotate_y_axis:float = field(default=0.)
     cached_rotate_z_axis:float = field(default=0.)
+    cached_transform:np.ndarray = field(default=None)
 
     def clear_dock(self):
         self.dock.clear()
 
     def get_dock(self):
         return self.dock
+
+    def batch(self):
+        # with sw.batch(): ... defers dirty propagation and sanitizing of the dock to the end
+        return self.dock.batch()
     
     def start_display(self):
         self.dock.start_display()
@@ -39,6 +46,11 @@ class Shipwright:
         self.cached_rotate_z_axis = rotate_z_axis
         return self
 
+    def transform(self, translation):
+        # translation: 4x4 affine matrix (row vector convention), applied before the cached rotation
+        self.cached_transform = translation
+        return self
+
     def set_parent(self, ship, parent, position=1.):
         self.dock.set_parent(ship, parent, position)
     
@@ -54,6 +66,10 @@ class Shipwright:
                 self.cached_rotate_y_axis, self.cached_rotate_z_axis)
             self.cached_rotate_y_axis = 0.
             self.cached_rotate_z_axis = 0.
+
+        if self.cached_transform is not None:
+            self.dock.transform_keel(ship, np.dot(self.cached_transform, ship.keel.relative_translation))
+            self.cached_transform = None
         
         return ship
 
@@ -70,35 +86,31 @@ class Shipwright:
                 return self.load_stl(file)
         return None
 
-    def load_stl(self, path):
+    def load_stl(self, path, array_shell=False, weld_cache=None, vertex_matching=False, tolerance=0.):
         ship = self.dock.generate_ship()
-        ship.load_stl(path)
+        ship.load_stl(path, vertex_matching, array_shell, weld_cache, tolerance)
         return self.set_cached_parameter(ship)
     
-    def load_huge_binary_stl(self, path):
+    def load_huge_binary_stl(self, path, array_shell=False, tolerance=0.):
         ship = self.dock.generate_ship()
-        ship.load_huge_binary_stl(path)
+        ship.load_huge_binary_stl(path, array_shell, tolerance)
         return self.set_cached_parameter(ship)
 
-    def load_submodule(self, path, force_load_merged_stl=False, vertex_matching=True):
+    def load_submodule(self, path, force_load_merged_stl=False, vertex_matching=True, workers=1, weld_cache=None):
         obj_from_stl = self.dock.generate_ship()
         max_z_position = 0. # z_length_position
-        submodule_sehlls = load_util.load_submodule(path, force_load_merged_stl, vertex_matching)
+        submodule_sehlls = load_util.load_submodule(path, force_load_merged_stl, vertex_matching, workers, weld_cache)
         if 1 == len(submodule_sehlls):
             obj_from_stl.monocoque_shell = submodule_sehlls[0]
             # z_position calc
-            for position in obj_from_stl.monocoque_shell.positions:
-                if max_z_position < position.position[2]:
-                    max_z_position = position.position[2]
+            max_z_position = obj_from_stl.monocoque_shell.max_z_position()
         else:
             for shell in submodule_sehlls:
                 divided_module = self.dock.generate_ship()
-                divided_module.set_parent(obj_from_stl, 0.)
+                self.dock.set_parent(divided_module, obj_from_stl, 0.)
                 divided_module.monocoque_shell = shell
                 # z_position calc
-                for position in divided_module.monocoque_shell.positions:
-                    if max_z_position < position.position[2]:
-                        max_z_position = position.position[2]
+                max_z_position = max(max_z_position, shell.max_z_position())
         obj_from_stl.monocoque_shell_max_z_position = max_z_position
 
         return self.set_cached_parameter(obj_from_stl)
@@ -300,13 +312,22 @@ class Shipwright:
         return self.set_cached_parameter(base)
     
     def scale(self, scale, target_root=None):
+        self.dock.sanitize_parents()
+        scaled_ships = []
         for ship in self.dock.ships:
             if target_root == None or ship.is_contains_in_parents(target_root):
                 ship.keel.length = scale*ship.keel.length
+                # offsets of move_x, move_y, ... are in the translation row
+                relative_translation = ship.keel.relative_translation.copy()
+                relative_translation[3, :3] *= scale
+                ship.keel.set_relative_translation(relative_translation)
+                scaled_ships.append(ship)
                 for rib in ship.ribs:
                     rib.edges = [(e[0]*scale,e[1]*scale) for e in rib.edges]
                 if ship.monocoque_shell != None:
                     self.deformation(ship, lambda x,y,z: (x*scale,y*scale,z*scale), False) 
+        for ship in self.dock.iterate_union_of_descendants(scaled_ships):
+            ship.translation_dirty_flag = True
     
     def deformation(self, ship, deformation_fanc, recursive_1_degree=True):
         if not ship.is_monocoque():
@@ -330,35 +351,17 @@ class Shipwright:
             self.shell_positions_deform(ship, deformation_fanc)
         
     def shell_positions_deform(self, ship, deformation_fanc):
-        for position in ship.monocoque_shell.positions:
-            pos = position.position
-            new_x_y_z = deformation_fanc(pos[0], pos[1], pos[2])
-            if None != new_x_y_z:
-                pos[0] = new_x_y_z[0]
-                pos[1] = new_x_y_z[1]
-                pos[2] = new_x_y_z[2]
+        ship.monocoque_shell.deform(deformation_fanc)
     
     def move_x(self, x):
-        if x > 0.:
-            void_1 = self.rotate(np.pi/2.).void(x)
-            return self.rotate(-np.pi/2.).parent(void_1).void()
-        else:
-            void_1 = self.rotate(-np.pi/2.).void(abs(x))
-            return self.rotate(np.pi/2.).parent(void_1).void()
+        # one void ship whose keel is the translation, the cached rotation is discarded
+        return self.rotate().transform(Keel.translation_matrix(x, 0., 0.)).void()
     
     def move_y(self, y):
-        if y > 0.:
-            void_1 = self.rotate(np.pi/2., np.pi/2.).void(y)
-            void_2 = self.rotate(-np.pi/2.).parent(void_1).void()
-            return self.rotate(0., -np.pi/2.).parent(void_2).void()
-        else:
-            void_1 = self.rotate(-np.pi/2., np.pi/2.).void(abs(y))
-            void_2 = self.rotate(np.pi/2.).parent(void_1).void()
-            return self.rotate(0., -np.pi/2.).parent(void_2).void()
+        return self.rotate().transform(Keel.translation_matrix(0., y, 0.)).void()
     
     def move_xy(self, x, y):
-        move_1 = self.move_x(x)
-        return self.parent(move_1).move_y(y)
+        return self.rotate().transform(Keel.translation_matrix(x, y, 0.)).void()
     
     def move_z(self, z):
         if (z < 0.):
@@ -367,24 +370,23 @@ class Shipwright:
             return self.void(z)
 
     def move_z_back(self, back_z):
-        rotate_1 = self.parent(self.void()).rotate(np.pi).void(back_z)
-        return self.rotate(np.pi).parent(rotate_1).void()
+        # the cached rotation is applied before moving
+        return self.transform(Keel.translation_matrix(0., 0., -back_z)).void()
     
     def rotate_x(self, rad_x):
-        rotate_1 = self.rotate(rad_x, -np.pi/2).void()
-        return self.rotate(0., np.pi/2).parent(rotate_1).void()
+        return self.rotate().transform(Keel.rotation_matrix_x(rad_x)).void()
     
+    def set_name(self, ship, name):
+        self.dock.set_name(ship, name)
+        return ship
+
     def fetch_by_name(self, name):
-        fetched = []
-        for ship in self.dock.ships:
-            if ship.name == name:
-                fetched.append(ship)
-        return fetched
+        return self.dock.fetch_by_name(name)
     
     def rotate_bone_xyz_euler(self, x, y, z):
-        rotate_1 = self.rotate(-z).void()
-        rotate_2 = self.parent(rotate_1).rotate(0., y).void()
-        return self.parent(rotate_2).rotate_x(x)
+        # rotation around y axis by -z, around z axis by y, and around x axis by x in one void ship
+        translation = np.dot(np.dot(Keel.rotation_matrix_x(x), Keel.rotation_matrix_z(y)), Keel.rotation_matrix_y(-z))
+        return self.rotate().transform(translation).void()
     
     def rotate_bone(self, pw:PostureWrapper, bone_key:str):
         rotate_info = pw.fetch_bone_rotate_dict(bone_key)
@@ -437,7 +439,7 @@ class Shipwright:
                 objects[target_name] = self.parent(obj_geta_1).void(pw.fetch(target_name, BoneKeys.length))
         return objects, scale
     
-    def load_submodules_name_match(self, bone_objects:dict, list_path:list, alias:dict = {}, scale:dict = {}):
+    def load_submodules_name_match(self, bone_objects:dict, list_path:list, alias:dict = {}, scale:dict = {}, weld_cache=None):
         submodules = {}
         for k,v in bone_objects.items():
             for path in list_path:
@@ -445,16 +447,16 @@ class Shipwright:
                 if k in alias.keys():
                     submodule_path = os.path.join(path, alias[k])
                 if os.path.exists(submodule_path) and os.path.isdir(submodule_path):
-                    submodules[k] = self.parent(v,0.).load_submodule(submodule_path, True, False)
+                    submodules[k] = self.parent(v,0.).load_submodule(submodule_path, True, False, weld_cache=weld_cache)
                     if k in scale and scale[k] != 1:
                         self.deformation(submodules[k], lambda x,y,z: (x*scale[k],y*scale[k],z*scale[k]), False)
-                    submodules[k].name = k
+                    self.dock.set_name(submodules[k], k)
                     break
                 if os.path.isfile(submodule_path + ".stl"):
-                    submodules[k] = self.parent(v,0.).load_stl(submodule_path + ".stl")
+                    submodules[k] = self.parent(v,0.).load_stl(submodule_path + ".stl", weld_cache=weld_cache)
                     if k in scale and scale[k] != 1:
                         self.deformation(submodules[k], lambda x,y,z: (x*scale[k],y*scale[k],z*scale[k]), False)
-                    submodules[k].name = k
+                    self.dock.set_name(submodules[k], k)
                     break
         return submodules
     
@@ -470,39 +472,77 @@ class Shipwright:
         parent_object_base = self.parent(parent_object_base).move_xy(-origin_bone_axis_offset.global_x(), -origin_bone_axis_offset.global_y())
         return parent_object_base
 
-    def generate_stl(self, path, fname):
+    def generate_stl(self, path, fname, precision=None):
+        # precision: None: shortest representation, int: digits after the decimal point (fixed-point notation)
         print("output stl file: ", fname)
         file_full_name = os.path.join(path, fname)
-        f = open(file_full_name, "w", encoding="ascii")
+        with open(file_full_name, "w", encoding="ascii", buffering=1<<20) as f:
+            self.write_stl(f, precision)
+
+    def generate_ply(self, path, fname):
+        # binary PLY, all ships are merged into one mesh
+        print("output ply file: ", fname)
+        with open(os.path.join(path, fname), "wb") as f:
+            export_util.write_ply_binary(f, self.dock.generate_indexed_meshes())
+
+    def generate_obj(self, path, fname, separate_ships=True, precision=None):
+        # separate_ships: one object for each ship named by Ship.name, otherwise one merged object
+        # precision: None: shortest representation, int: digits after the decimal point (fixed-point notation)
+        print("output obj file: ", fname)
+        meshes = self.dock.generate_indexed_meshes()
+        if not separate_ships:
+            meshes = [export_util.merge_indexed_meshes(meshes)]
+        with open(os.path.join(path, fname), "w", encoding="utf-8", buffering=1<<20) as f:
+            export_util.write_obj(f, meshes, precision)
+
+    def generate_3mf(self, path, fname, separate_ships=True, unit='millimeter'):
+        # separate_ships: one object for each ship named by Ship.name, otherwise one merged object
+        print("output 3mf file: ", fname)
+        meshes = self.dock.generate_indexed_meshes()
+        if not separate_ships:
+            meshes = [export_util.merge_indexed_meshes(meshes, os.path.splitext(fname)[0])]
+        export_util.write_3mf(os.path.join(path, fname), meshes, unit)
+
+    def write_stl(self, f, precision=None):
+        # f: writable text stream
         f.write("solid \n")
-        self.dock.write_stl(f)
+        self.dock.write_stl(f, precision)
         f.write("endsolid ")
-        f.close()
 
-    def generate_stl_binary(self, path, fname, concatinated=True, divided=True):
-        print("output stl file: ", fname)
-        if concatinated:
-            file_full_name = os.path.join(path, fname)
-            f = open(file_full_name, "wb")
-            # 80Byte padding
-            for i in range(8):
-                f.write(struct.pack("xxxxxxxxxx"))
-            
-            # count triangles
-            count = self.dock.count_triangles()
-            f.write(struct.pack("<L", count))
+    def write_stl_binary(self, f):
+        # f: writable binary stream, the header is patched afterwards if f is seekable
+        if f.seekable():
+            return self.dock.write_stl_binary(f)
+        view = self.dock.render_stl_binary()
+        f.write(view)
+        return (len(view) - load_util.stl_binary_header_size) // model_util.stl_binary_record_dtype.itemsize
 
-            # write triangles data
-            self.dock.write_stl_binary(f)
-            f.close()
-        
+    def render_stl_binary(self, buffer=None):
+        # return: memoryview of the binary stl, bytes(...) of it to keep
+        return self.dock.render_stl_binary(buffer)
+
+    def generate_stl_binary(self, path, fname, concatinated=True, divided=True, workers=1, incremental=False, background_io=False, array_shell=False):
+        # workers: number of processes converting ships to monocoque, None: number of cpus
+        # background_io: files are written by a writer thread while the next ships are converted
+        # incremental: keep the divided directory, only changed files are rewritten and orphaned files are deleted
+        # array_shell: ships with ribs are left with ArrayMonocoqueShell instead of MonocoqueShell
+        print("output stl file: ", fname)
+        dir_full_name = None
         if divided:
             dir_full_name = os.path.join(path, 'divided')
-            try:
-                shutil.rmtree(dir_full_name)
-            except FileNotFoundError:
-                pass # ignore
+            if incremental:
+                os.makedirs(dir_full_name, exist_ok=True)
+            else:
+                try:
+                    shutil.rmtree(dir_full_name)
+                except FileNotFoundError:
+                    pass # ignore
 
-            os.mkdir(dir_full_name)
+                os.mkdir(dir_full_name)
 
-            self.dock.write_stl_binary_divided(dir_full_name)
+        if concatinated:
+            file_full_name = os.path.join(path, fname)
+            with open(file_full_name, "wb") as f:
+                self.dock.write_stl_binary(f, dir_full_name, workers, background_io, array_shell=array_shell)
+        elif divided:
+            self.dock.write_stl_binary_divided(dir_full_name, workers, background_io, array_shell)
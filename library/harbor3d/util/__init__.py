@@ -4,6 +4,7 @@ from harbor3d.util.bpy_util import *
 from harbor3d.util.calc_util import *
 from harbor3d.util.display_util import *
 from harbor3d.util.edges_util import *
+from harbor3d.util.export_util import *
 from harbor3d.util.json_util import *
 from harbor3d.util.load_rib_from_bmp_util import *
 from harbor3d.util.load_util import *
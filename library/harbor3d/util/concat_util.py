@@ -5,7 +5,7 @@ import sys, struct
 from typing import List, Dict, Any
 
 from harbor3d import Shipwright
-from harbor3d.util import load_util, calc_util
+from harbor3d.util import load_util
 from harbor3d.util.model_util import Facet
 
 @dataclass
@@ -18,6 +18,7 @@ class ConcatConfig:
     merge_consecutive_face:bool = True
     recalc_z_bias:float = 0.
     recalc_x_bias:float = 0.
+    use_area_sidecar:bool = False
 
     def __post_init__(self):
         if self.recalc_z_bias == 0.:
@@ -42,47 +43,80 @@ class ConcatConfig:
 @dataclass
 class ShellData:
     catConfig:ConcatConfig
-    sw:Shipwright
     path:str
     area_info:tuple = None
-    triangles:List[Any] = field(default_factory=list)
     penetrate_dict_key_stage:dict = field(default_factory=dict)
 
     def __post_init__(self):
         self.fetch_area(self.path)
 
-    def fetch_triangles(self):
-        self.sw.clear_dock()
-        ship = self.sw.load_stl(self.path)
-        self.triangles = ship.monocoque_shell.triangles
+    def fetch_penetrations(self, stage_min_index, stage_max_index):
+        # all stages are scanned in a single streaming pass over the stl file,
+        # only the rays with odd number of penetrations are scanned again with bias
+        # return: True if the shell is in the z area of any stage, even if it is too narrow for any ray
+        x_scan_min_index, x_scan_max_index = self.scan_x_index_range()
+        x_scan_indexes = list(range(x_scan_min_index, x_scan_max_index + 1))
+        rays_key_stage = {}
+        for stage_index in range(stage_min_index, stage_max_index + 1):
+            if self.is_included_in_z_area(self.catConfig.stage_position(stage_index)):
+                rays_key_stage[stage_index] = x_scan_indexes
+        if 0 == len(rays_key_stage):
+            return False
+        if 0 == len(x_scan_indexes):
+            return True
+
+        penetrations = self.scan_penetrations(rays_key_stage, 0., 0.)
+        for x_bias, z_bias in [(0., self.catConfig.recalc_z_bias), (self.catConfig.recalc_x_bias, self.catConfig.recalc_z_bias)]:
+            odd_rays = [key for key, list_penetration in penetrations.items() if len(list_penetration)%2 != 0]
+            if 0 == len(odd_rays):
+                break
+            rays_key_stage = {}
+            for stage_index, x_scan_index in odd_rays:
+                rays_key_stage.setdefault(stage_index, []).append(x_scan_index)
+            penetrations_recalc = self.scan_penetrations(rays_key_stage, x_bias, z_bias)
+            for key in odd_rays:
+                penetrations[key] = penetrations_recalc.get(key, [])
+        if any(len(list_penetration)%2 != 0 for list_penetration in penetrations.values()):
+            raise Exception()
+
+        for (stage_index, x_scan_index), list_penetration in sorted(penetrations.items()):
+            if 0 == len(list_penetration):
+                continue
+            dict_key_stage = self.penetrate_dict_key_stage.setdefault(stage_index, {})
+            if x_scan_index in dict_key_stage:
+                dict_key_stage[x_scan_index].extend(list_penetration)
+            else:
+                dict_key_stage[x_scan_index] = list_penetration
+        return True
+
+    def scan_penetrations(self, rays_key_stage, x_bias, z_bias):
+        # rays_key_stage: {stage_index: [x_scan_index, ...]}
+        # return: {(stage_index, x_scan_index): [y, ...]}
+        y_shell_length = self.y_max() - self.y_min()
+        y_start = self.y_min() - y_shell_length/10.
+        y_length = y_shell_length*1.2
+        rays = []
+        for stage_index, x_scan_indexes in rays_key_stage.items():
+            # calc_penetration_y_axis_pararell_array needs ascending x_scans
+            x_scan_indexes = sorted(x_scan_indexes)
+            x_scans = np.array([self.catConfig.x_position(x_scan_index) for x_scan_index in x_scan_indexes]) + x_bias
+            rays.append((stage_index, x_scan_indexes, x_scans, self.catConfig.stage_position(stage_index) + z_bias))
+        z_range = (min(ray[3] for ray in rays), max(ray[3] for ray in rays))
+
+        penetrations = {}
+        for triangle_vertexes in load_util.iter_binary_stl_triangle_vertexes(self.path, z_range=z_range):
+            triangle_vertexes = triangle_vertexes.astype(np.float64)
+            for stage_index, x_scan_indexes, x_scans, z in rays:
+                ray_indexes, list_y = calc_penetration_y_axis_pararell_array(triangle_vertexes, x_scans, z, y_start, y_length)
+                for ray_index, y in zip(ray_indexes.tolist(), list_y.tolist()):
+                    penetrations.setdefault((stage_index, x_scan_indexes[ray_index]), []).append(y)
+        return penetrations
     
     def fetch_area(self, stl_full_path):
-        vertexes = load_util.load_vertexes(stl_full_path)
-
-        x_min = sys.float_info.max
-        x_max = -sys.float_info.max
-        y_min = sys.float_info.max
-        y_max = -sys.float_info.max
-        z_min = sys.float_info.max
-        z_max = -sys.float_info.max
-
-        for vertex in vertexes:
-            if x_min > vertex[0]:
-                x_min = vertex[0]
-            if x_max < vertex[0]:
-                x_max = vertex[0]
-
-            if y_min > vertex[1]:
-                y_min = vertex[1]
-            if y_max < vertex[1]:
-                y_max = vertex[1]
-
-            if z_min > vertex[2]:
-                z_min = vertex[2]
-            if z_max < vertex[2]:
-                z_max = vertex[2]
-        
-        self.area_info = ((x_min, x_max), (y_min, y_max), (z_min, z_max))
+        self.area_info = load_util.load_binary_stl_area(stl_full_path, self.catConfig.use_area_sidecar)
+        if self.area_info is None:
+            empty_range = (sys.float_info.max, -sys.float_info.max)
+            self.area_info = (empty_range, empty_range, empty_range)
         
     def x_min(self):
         return self.area_info[0][0]
@@ -126,7 +160,7 @@ class Concatinator:
     dict_array_xm_union:Dict = field(default_factory=dict)
     dict_array_yp_union:Dict = field(default_factory=dict)
     dict_array_ym_union:Dict = field(default_factory=dict)
-    default_stage_array:np.ndarray = np.array([])
+    default_stage_array:np.ndarray = field(default_factory=lambda: np.array([]))
     stage_array_offset_x_index:int = 0
     stage_array_offset_y_index:int = 0
     x_max:float = field(default=-sys.float_info.max)
@@ -146,7 +180,7 @@ class Concatinator:
     def init_shells_data(self, list_path):
         self.shells_path = list_path
         for path in list_path:
-            shell = ShellData(self.catConfig, self.sw, path)
+            shell = ShellData(self.catConfig, path)
             self.shells.append(shell)
             print(path)
         self.z_range = self.fetch_z_range()
@@ -219,50 +253,14 @@ class Concatinator:
         print("stage_min_i:", stage_min_index)
         print("stage_max_i:", stage_max_index)
 
-        for stage_index in range(stage_min_index, stage_max_index + 1):
-            stage = self.catConfig.stage_position(stage_index)
-            for shellData in self.shells:
-                if not shellData.is_included_in_z_area(stage):
-                    if shellData.z_max() < stage and 0 != len(shellData.triangles):
-                        shellData.triangles = []
-                    continue
-                if 0 == len(shellData.triangles):
-                    shellData.fetch_triangles()
-                    # memorize range min, max
-                    if self.x_max < shellData.x_max() : self.x_max = shellData.x_max()
-                    if shellData.x_min() < self.x_min : self.x_min = shellData.x_min()
-                    if self.y_max < shellData.y_max() : self.y_max = shellData.y_max()
-                    if shellData.y_min() < self.y_min : self.y_min = shellData.y_min()
-                x_scan_min_index, x_scan_max_index = shellData.scan_x_index_range()
-                y_shell_length = shellData.y_max() - shellData.y_min()
-                y_start = shellData.y_min() - y_shell_length/10.
-                y_vector = np.array([0., y_shell_length*1.2, 0.])
-                for x_scan_index in range(x_scan_min_index, x_scan_max_index + 1):
-                    x_scan = self.catConfig.x_position(x_scan_index)
-                    y_start_pos = np.array([x_scan, y_start, stage])
-                    list_penetration = calc_penetration_y_axis_pararell(shellData.triangles, y_start_pos, y_vector)
-
-                    if len(list_penetration)%2 != 0:
-                        y_start_pos[2] = y_start_pos[2] + self.catConfig.recalc_z_bias
-                        list_penetration = calc_penetration_y_axis_pararell(shellData.triangles, y_start_pos, y_vector)
-                    
-                    if len(list_penetration)%2 != 0:
-                        y_start_pos[0] = y_start_pos[0] + self.catConfig.recalc_x_bias
-                        list_penetration = calc_penetration_y_axis_pararell(shellData.triangles, y_start_pos, y_vector)
-                    
-                    if len(list_penetration)%2 != 0:
-                        raise Exception()
-
-                    if None == list_penetration or 0 == len(list_penetration):
-                        continue
-                    if stage_index in shellData.penetrate_dict_key_stage:
-                        dict_key_stage = shellData.penetrate_dict_key_stage[stage_index]
-                        if x_scan_index in dict_key_stage:
-                            dict_key_stage[x_scan_index].extend(list_penetration)
-                        else:
-                            dict_key_stage[x_scan_index] = list_penetration
-                    else:
-                        shellData.penetrate_dict_key_stage[stage_index] = {x_scan_index: list_penetration}
+        for shellData in self.shells:
+            if not shellData.fetch_penetrations(stage_min_index, stage_max_index):
+                continue
+            # memorize range min, max of every shell in the z area, with or without penetrations
+            if self.x_max < shellData.x_max() : self.x_max = shellData.x_max()
+            if shellData.x_min() < self.x_min : self.x_min = shellData.x_min()
+            if self.y_max < shellData.y_max() : self.y_max = shellData.y_max()
+            if shellData.y_min() < self.y_min : self.y_min = shellData.y_min()
         self.set_stage_default_array()
     
     def output(self, outfile_fullpath):
@@ -1223,38 +1221,42 @@ def float_to_int_range_included(float_min, float_max, scale):
         max_index = max_index - 1
     return (min_index, max_index)
 
-def calc_penetration_y_axis_pararell(triangles, y_start_pos, y_vector):
-    y_end_pos = y_start_pos + y_vector
-    list_penetration = []
-    for triangle in triangles:
-        if not calc_util.is_positions_and_array_overrap_on_plane(triangle.get_positions(), [y_start_pos, y_end_pos], 0):
-            continue
-        if not calc_util.is_positions_and_array_overrap_on_plane(triangle.get_positions(), [y_start_pos, y_end_pos], 2):
-            continue
-        vector_ray_to_v1 = calc_util.extract_vector_1by3(triangle.vertex_1.position)-y_start_pos
-        vector_ray_to_v2 = calc_util.extract_vector_1by3(triangle.vertex_2.position)-y_start_pos
-        vector_ray_to_v3 = calc_util.extract_vector_1by3(triangle.vertex_3.position)-y_start_pos
-
-        outer1_2 = np.cross(vector_ray_to_v1, vector_ray_to_v2)
-        outer2_3 = np.cross(vector_ray_to_v2, vector_ray_to_v3)
-        outer3_1 = np.cross(vector_ray_to_v3, vector_ray_to_v1)
-
-        inner_product_with_side1_2 = np.dot(outer1_2, y_vector)
-        inner_product_with_side2_3 = np.dot(outer2_3, y_vector)
-        inner_product_with_side3_1 = np.dot(outer3_1, y_vector)
-        
-        if 0 >= inner_product_with_side1_2 * inner_product_with_side2_3 \
-            or 0 >= inner_product_with_side1_2 * inner_product_with_side3_1:
-            continue
-
-        vector_side1_2 = calc_util.extract_vector_1by3(triangle.vertex_1.vector_to(triangle.vertex_2))
-        vector_side1_3 = calc_util.extract_vector_1by3(triangle.vertex_1.vector_to(triangle.vertex_3))
-        vector_ray_origin_to_vertex1 = y_start_pos-calc_util.extract_vector_1by3(triangle.vertex_1.position)
-        
-        solved = np.dot(vector_ray_origin_to_vertex1, np.linalg.inv(np.array([-y_vector, vector_side1_2, vector_side1_3])))
-        list_penetration.append(y_start_pos[1] + y_vector[1] * solved[0])
-            
-    return list_penetration
+def calc_penetration_y_axis_pararell_array(triangle_vertexes, x_scans, z, y_start, y_length):
+    # triangle_vertexes: (number of triangles, 3, 3), x_scans: ascending x positions of the rays
+    # return: indexes of x_scans, y positions of the penetrations
+    # rays: (x_scan, y_start, z) + (0, y_length, 0)
+    z_vertexes = triangle_vertexes[:, :, 2]
+    triangle_vertexes = triangle_vertexes[(z_vertexes.min(axis=1) <= z) & (z <= z_vertexes.max(axis=1))]
+    x_vertexes = triangle_vertexes[:, :, 0]
+    x_scan_start = np.searchsorted(x_scans, x_vertexes.min(axis=1), side='left')
+    x_scan_end = np.searchsorted(x_scans, x_vertexes.max(axis=1), side='right')
+    counts = np.maximum(x_scan_end - x_scan_start, 0)
+    triangle_indexes = np.repeat(np.arange(len(triangle_vertexes)), counts)
+    ray_indexes = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(x_scan_start, counts)
+
+    vertexes = triangle_vertexes[triangle_indexes]
+    x_rays = x_scans[ray_indexes]
+    vector_ray_to_x = vertexes[:, :, 0] - x_rays[:, np.newaxis]
+    vector_ray_to_z = vertexes[:, :, 2] - z
+    # y element of the outer products
+    outer1_2 = vector_ray_to_z[:, 0] * vector_ray_to_x[:, 1] - vector_ray_to_x[:, 0] * vector_ray_to_z[:, 1]
+    outer2_3 = vector_ray_to_z[:, 1] * vector_ray_to_x[:, 2] - vector_ray_to_x[:, 1] * vector_ray_to_z[:, 2]
+    outer3_1 = vector_ray_to_z[:, 2] * vector_ray_to_x[:, 0] - vector_ray_to_x[:, 2] * vector_ray_to_z[:, 0]
+    inner_product_with_side1_2 = outer1_2 * y_length
+    inner_product_with_side2_3 = outer2_3 * y_length
+    inner_product_with_side3_1 = outer3_1 * y_length
+    penetrated = (0 < inner_product_with_side1_2 * inner_product_with_side2_3) \
+        & (0 < inner_product_with_side1_2 * inner_product_with_side3_1)
+    vertexes = vertexes[penetrated]
+    ray_indexes = ray_indexes[penetrated]
+
+    matrixes = np.zeros((len(vertexes), 3, 3))
+    matrixes[:, 0, 1] = -y_length
+    matrixes[:, 1] = vertexes[:, 1] - vertexes[:, 0]
+    matrixes[:, 2] = vertexes[:, 2] - vertexes[:, 0]
+    vector_ray_origin_to_vertex1 = np.stack([x_scans[ray_indexes], np.full(len(vertexes), y_start), np.full(len(vertexes), z)], axis=1) - vertexes[:, 0]
+    solved = np.einsum('ij,ij->i', vector_ray_origin_to_vertex1, np.linalg.inv(matrixes)[:, :, 0]) if 0 != len(vertexes) else np.zeros(0)
+    return ray_indexes, y_start + y_length * solved
 
 class OutputFlag:
     flag_exist = 0b00000001
@@ -52,7 +52,12 @@ def draw_ship(ship):
         draw_normal_ship(ship)
     
 def draw_monocoque_shell(ship):
-    ship.monocoque_shell.translate(np.dot(ship.keel.relative_translation, ship.keel.origin_translation))
+    if ship.is_array_monocoque():
+        # ArrayMonocoqueShell has no Triangle objects, draw from its arrays
+        for vertexes in ship.monocoque_shell.triangle_vertexes(ship.world_translation()):
+            draw_triangle_vertexes(vertexes)
+        return
+    ship.monocoque_shell.translate(ship.world_translation())
         
     for triangle in ship.monocoque_shell.triangles:
         draw_triangle(triangle)
@@ -74,6 +79,9 @@ def start_display(dock, translate_vel, translate_matlix_start, rotate_radian_vel
 def draw_triangle(triangle):
     pass
 
+def draw_triangle_vertexes(vertexes):
+    pass
+
 def draw_rib(keel, rib, former_rib_edges):
     pass
 
@@ -167,6 +175,14 @@ def draw_beam(rib_edges, former_rib_edges):
     
 #     glEnd()
 
+# def draw_triangle_vertexes(vertexes):
+#     glLineWidth(1)
+#     glBegin(GL_LINE_LOOP)
+#     glColor3f(0,1,0.5)
+#     for vertex in vertexes:
+#         glVertex3fv((vertex[0], vertex[1], vertex[2]))
+#     glEnd()
+
 # def draw_rib(keel, rib, former_rib_edges):
 #     if rib.edges is None or len(rib.edges) == 0:
 #         return None
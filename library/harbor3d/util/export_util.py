@@ -0,0 +1,158 @@
+import queue
+import threading
+import zipfile
+from xml.sax.saxutils import quoteattr
+
+import numpy as np
+
+class OrderedWriter:
+    # runs write tasks in the order of submission
+    # background: tasks run in a writer thread, at most max_queued_tasks tasks wait in the queue
+    # otherwise tasks run immediately in the calling thread
+    def __init__(self, background=True, max_queued_tasks=8):
+        self.error = None
+        self.thread = None
+        if background:
+            self.tasks = queue.Queue(maxsize=max_queued_tasks)
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            if self.error is not None:
+                continue # drain the queue, the error is raised in the submitting thread
+            try:
+                task[0](*task[1])
+            except BaseException as e:
+                self.error = e
+
+    def submit(self, function, *args):
+        if self.error is not None:
+            raise self.error
+        if self.thread is None:
+            function(*args)
+        else:
+            self.tasks.put((function, args))
+
+    def close(self):
+        # wait until all submitted tasks are done
+        if self.thread is not None:
+            self.tasks.put(None)
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self.thread is not None:
+            self.tasks.put(None)
+            self.thread.join()
+            self.thread = None
+        return False
+
+# indexed meshes: list of (name, vertexes (N, 3), faces (M, 3) indexes of vertexes)
+
+def merge_indexed_meshes(meshes, name=None):
+    vertexes = []
+    faces = []
+    offset = 0
+    for _, mesh_vertexes, mesh_faces in meshes:
+        vertexes.append(mesh_vertexes)
+        faces.append(np.asarray(mesh_faces, dtype=np.int64) + offset)
+        offset += len(mesh_vertexes)
+    if 0 == len(meshes):
+        return name, np.zeros((0, 3)), np.zeros((0, 3), dtype=np.int64)
+    return name, np.concatenate(vertexes), np.concatenate(faces)
+
+ply_vertex_dtype = np.dtype([('x', '<f4'), ('y', '<f4'), ('z', '<f4')])
+# uchar(number of indexes = 3) + int32 * 3 = 13byte, packed
+ply_face_dtype = np.dtype([('count', 'u1'), ('indexes', '<i4', (3,))])
+
+def write_ply_binary(f, meshes):
+    # PLY has no object, all meshes are merged into one
+    _, vertexes, faces = merge_indexed_meshes(meshes)
+    header = 'ply\n'\
+        'format binary_little_endian 1.0\n'\
+        'comment generated by harbor3d\n'\
+        'element vertex {}\n'\
+        'property float x\n'\
+        'property float y\n'\
+        'property float z\n'\
+        'element face {}\n'\
+        'property list uchar int vertex_indices\n'\
+        'end_header\n'.format(len(vertexes), len(faces))
+    f.write(header.encode('ascii'))
+    vertex_records = np.zeros(len(vertexes), dtype=ply_vertex_dtype)
+    vertex_records['x'] = vertexes[:, 0]
+    vertex_records['y'] = vertexes[:, 1]
+    vertex_records['z'] = vertexes[:, 2]
+    f.write(vertex_records.tobytes())
+    face_records = np.zeros(len(faces), dtype=ply_face_dtype)
+    face_records['count'] = 3
+    face_records['indexes'] = faces
+    f.write(face_records.tobytes())
+
+def value_format(precision=None):
+    # precision: None: shortest representation, int: digits after the decimal point (fixed-point notation)
+    # shared by the ascii stl and obj writers so that precision means the same for both
+    return '%s' if precision is None else '%.' + str(int(precision)) + 'f'
+
+def write_obj(f, meshes, precision=None, chunk_size=8192):
+    # precision: see value_format
+    # indexes of faces start from 1 and continue across objects
+    vertex_format = 'v {0} {0} {0}\n'.format(value_format(precision))
+    offset = 1
+    for name, vertexes, faces in meshes:
+        if name is not None:
+            f.write('o {}\n'.format(name))
+        for start in range(0, len(vertexes), chunk_size):
+            f.write(''.join([vertex_format % tuple(row) for row in vertexes[start:start+chunk_size].tolist()]))
+        for start in range(0, len(faces), chunk_size):
+            f.write(''.join(['f %d %d %d\n' % tuple(row) for row in (faces[start:start+chunk_size] + offset).tolist()]))
+        offset += len(vertexes)
+
+threemf_content_types = '<?xml version="1.0" encoding="UTF-8"?>\n'\
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'\
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'\
+    '<Default Extension="model" ContentType="application/vnd.ms-package.3dmanufacturing-3dmodel+xml"/>'\
+    '</Types>'
+
+threemf_relationships = '<?xml version="1.0" encoding="UTF-8"?>\n'\
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'\
+    '<Relationship Target="/3D/3dmodel.model" Id="rel0" Type="http://schemas.microsoft.com/3dmanufacturing/2013/01/3dmodel"/>'\
+    '</Relationships>'
+
+def generate_3mf_model(meshes, unit='millimeter', chunk_size=8192):
+    # yield xml fragments of 3D/3dmodel.model, one object for each mesh
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n'\
+        '<model unit="{}" xml:lang="en-US" xmlns="http://schemas.microsoft.com/3dmanufacturing/core/2015/02">'\
+        '<resources>'.format(unit)
+    for index, (name, vertexes, faces) in enumerate(meshes):
+        name_attribute = '' if name is None else ' name=' + quoteattr(str(name))
+        yield '<object id="{}" type="model"{}><mesh><vertices>'.format(index + 1, name_attribute)
+        for start in range(0, len(vertexes), chunk_size):
+            yield ''.join(['<vertex x="%s" y="%s" z="%s"/>' % tuple(row) for row in vertexes[start:start+chunk_size].tolist()])
+        yield '</vertices><triangles>'
+        for start in range(0, len(faces), chunk_size):
+            yield ''.join(['<triangle v1="%d" v2="%d" v3="%d"/>' % tuple(row) for row in faces[start:start+chunk_size].tolist()])
+        yield '</triangles></mesh></object>'
+    yield '</resources><build>'
+    for index in range(len(meshes)):
+        yield '<item objectid="{}"/>'.format(index + 1)
+    yield '</build></model>'
+
+def write_3mf(file_full_name, meshes, unit='millimeter'):
+    with zipfile.ZipFile(file_full_name, 'w', compression=zipfile.ZIP_DEFLATED) as z:
+        z.writestr('[Content_Types].xml', threemf_content_types)
+        z.writestr('_rels/.rels', threemf_relationships)
+        with z.open('3D/3dmodel.model', 'w') as f:
+            for fragment in generate_3mf_model(meshes, unit):
+                f.write(fragment.encode('utf-8'))
@@ -1,159 +1,361 @@
+from dataclasses import dataclass, field
+
 import numpy as np
-import struct
 import os
 import glob
+import hashlib
 import subprocess
+import sys
+from concurrent.futures import ProcessPoolExecutor
 
 from harbor3d.util import model_util
+from harbor3d.util.json_util import JsonLoader
+
+stl_binary_header_size = 84 # 80byte header + 4byte triangle count
 
-def load_binary_stl(path, vertex_matching=True):
+def read_binary_stl_records(path):
     with open(path, "rb") as f:
-        read_block = f.read(80) # discard
-        read_block = f.read(4) # discard
+        f.seek(stl_binary_header_size)
+        # an incomplete record at the end of the file is discarded
+        return np.fromfile(f, dtype=model_util.stl_binary_record_dtype)
 
-        format = "<ffffffffffffxx" # 32bit-float(4byte) * 3 * 4 + padding(1byte) * 2 = 50byte, little endian
-        size = struct.calcsize(format)
+def read_binary_stl_vertexes(path):
+    # shape: (number of triangles, 3, 3), float32
+    return np.ascontiguousarray(read_binary_stl_records(path)['vertexes'])
 
-        triangles = []
-        positions = []
-        unpacked = tuple()
-        while True:
-            read_block = f.read(size)
-            if len(read_block) != size:
+def weld_vertexes(vertexes, tolerance=0.):
+    # vertexes: (number of triangles, 3, 3)
+    # tolerance: vertexes closer than tolerance are welded, 0: exact matching only
+    # return: unique vertexes (N, 3) in order of first appearance, faces (M, 3) int32
+    flat_vertexes = vertexes.reshape(-1, 3)
+    if 0 == len(flat_vertexes):
+        return flat_vertexes.copy(), np.zeros((0, 3), dtype=np.int32)
+    _, first_indexes, inverse = np.unique(flat_vertexes, axis=0, return_index=True, return_inverse=True)
+    order = np.argsort(first_indexes)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    faces = rank[inverse.reshape(-1)].reshape(-1, 3)
+    unique_vertexes = flat_vertexes[first_indexes[order]]
+    if 0. < tolerance:
+        unique_vertexes, faces = weld_vertexes_grid(unique_vertexes, faces, tolerance)
+    return unique_vertexes, faces.astype(np.int32)
+
+def weld_vertexes_grid(vertexes, faces, tolerance):
+    # uniform grid hash whose cell size is tolerance,
+    # the vertex within tolerance is always in the same or the adjacent 26 cells
+    cells = np.floor(vertexes.astype(np.float64) / tolerance).astype(np.int64).tolist()
+    vertexes_list = vertexes.tolist()
+    squared_tolerance = tolerance * tolerance
+    grid = dict() # key: cell, value: indexes of representative vertexes
+    representatives = np.empty(len(vertexes), dtype=np.int64)
+    for index, ((x, y, z), (cx, cy, cz)) in enumerate(zip(vertexes_list, cells)):
+        representative = -1
+        for neighbor in ((cx+dx, cy+dy, cz+dz) for dx in (-1, 0, 1) for dy in (-1, 0, 1) for dz in (-1, 0, 1)):
+            for candidate in grid.get(neighbor, ()):
+                rx, ry, rz = vertexes_list[candidate]
+                if (rx-x)*(rx-x) + (ry-y)*(ry-y) + (rz-z)*(rz-z) <= squared_tolerance:
+                    representative = candidate
+                    break
+            if 0 <= representative:
                 break
-            unpacked = struct.unpack(format, read_block)
-            vertex1 = np.array([unpacked[3], unpacked[4], unpacked[5], 1.])
-            vertex2 = np.array([unpacked[6], unpacked[7], unpacked[8], 1.])
-            vertex3 = np.array([unpacked[9], unpacked[10], unpacked[11], 1.])
-            vertexes = [vertex1, vertex2, vertex3]
-
-            triangle = []
-            for vertex in vertexes:
-                if vertex_matching:
-                    # finally, (number of positions) < 3 * (number of triangles)
-                    vertex_esists = [x for x in positions if x.position[0] == vertex[0] and x.position[1] == vertex[1] and x.position[2] == vertex[2]]
-                    if (0 == len (vertex_esists)):
-                        position = model_util.Position(vertex)
-                        positions.append(position)
-                        triangle.append(position)
-                    else:
-                        triangle.append(vertex_esists[0])
-                else:
-                    # finally, (number of positions) == 3 * (number of triangles)
-                    position = model_util.Position(vertex)
-                    positions.append(position)
-                    triangle.append(position)
-            triangles.append(model_util.Triangle(triangle[0], triangle[1], triangle[2]))
-            
-        return model_util.MonocoqueShell(positions, triangles)
-
-def load_huge_binary_stl(path):
+        if representative < 0:
+            representative = index
+            grid.setdefault((cx, cy, cz), []).append(index)
+        representatives[index] = representative
+
+    is_representative = representatives == np.arange(len(vertexes))
+    new_indexes = np.cumsum(is_representative) - 1
+    faces = new_indexes[representatives[faces]]
+    # triangles collapsed by welding are discarded
+    faces = faces[(faces[:, 0] != faces[:, 1]) & (faces[:, 1] != faces[:, 2]) & (faces[:, 2] != faces[:, 0])]
+    return vertexes[is_representative], faces
+
+def iter_binary_stl_triangle_vertexes(path, chunk_size=65536, z_range=None):
+    # yield: (number of triangles <= chunk_size, 3, 3), float32
+    # z_range: (z_min, z_max), only triangles overlapping the range are yielded
     with open(path, "rb") as f:
-        read_block = f.read(80) # discard
-        read_block = f.read(4) # discard
+        f.seek(stl_binary_header_size)
+        while True:
+            records = np.fromfile(f, dtype=model_util.stl_binary_record_dtype, count=chunk_size)
+            if 0 == len(records):
+                break
+            vertexes = np.ascontiguousarray(records['vertexes'])
+            if z_range is not None:
+                z = vertexes[:, :, 2]
+                vertexes = vertexes[(z.min(axis=1) <= z_range[1]) & (z_range[0] <= z.max(axis=1))]
+                if 0 == len(vertexes):
+                    continue
+            yield vertexes
+
+def convert_vertexes_to_array_monocoque_shell(vertexes, vertex_matching=True, tolerance=0.):
+    if vertex_matching:
+        unique_vertexes, faces = weld_vertexes(vertexes, tolerance)
+        return model_util.ArrayMonocoqueShell(unique_vertexes, faces)
+    return model_util.ArrayMonocoqueShell(
+        vertexes.reshape(-1, 3), np.arange(3 * len(vertexes), dtype=np.int32).reshape(-1, 3))
+
+def convert_vertexes_to_monocoque_shell(vertexes, vertex_matching=True, tolerance=0.):
+    # vertex_matching: (number of positions) < 3 * (number of triangles)
+    # otherwise: (number of positions) == 3 * (number of triangles)
+    return convert_vertexes_to_array_monocoque_shell(vertexes, vertex_matching, tolerance).to_monocoque_shell()
+
+def load_binary_stl(path, vertex_matching=True, weld_cache=None, tolerance=0.):
+    if weld_cache:
+        return load_binary_stl_array(path, vertex_matching, weld_cache, tolerance).to_monocoque_shell()
+    return convert_vertexes_to_monocoque_shell(read_binary_stl_vertexes(path), vertex_matching, tolerance)
+
+def load_binary_stl_array(path, vertex_matching=True, weld_cache=None, tolerance=0.):
+    # weld_cache: None: not cached, True: cached next to the stl, str: cache directory
+    if weld_cache:
+        return load_weld_cache(path, vertex_matching, weld_cache, tolerance)
+    return convert_vertexes_to_array_monocoque_shell(read_binary_stl_vertexes(path), vertex_matching, tolerance)
+
+weld_cache_directory_name = ".weld_cache"
 
-        format = "<ffffffffffffxx" # 32bit-float(4byte) * 3 * 4 + padding(1byte) * 2 = 50byte, little endian
-        size = struct.calcsize(format)
+def fetch_weld_cache_dir(path, weld_cache):
+    if True is weld_cache:
+        return os.path.join(os.path.dirname(os.path.abspath(path)), weld_cache_directory_name)
+    return weld_cache
 
-        triangles = []
-        positions_dict = dict()
-        unpacked = tuple()
-        count = 0
+def calc_file_hash(path, chunk_size=1 << 24):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
         while True:
-            count = count + 1
-            if 0 == count%100:
-                print(count)
-            read_block = f.read(size)
-            if len(read_block) != size:
+            read_block = f.read(chunk_size)
+            if 0 == len(read_block):
                 break
-            unpacked = struct.unpack(format, read_block)
-            vertex1 = np.array([unpacked[3], unpacked[4], unpacked[5], 1.])
-            vertex2 = np.array([unpacked[6], unpacked[7], unpacked[8], 1.])
-            vertex3 = np.array([unpacked[9], unpacked[10], unpacked[11], 1.])
-            vertexes = [vertex1, vertex2, vertex3]
-
-            triangle = []
-            for vertex in vertexes:
-                if not vertex[2] in positions_dict:
-                    positions_dict[vertex[2]] = []
-                
-                vertex_esists = [x for x in positions_dict[vertex[2]] if x.position[0] == vertex[0] and x.position[1] == vertex[1] and x.position[2] == vertex[2]]
-                if (0 == len (vertex_esists)):
-                    position = model_util.Position(vertex)
-                    positions_dict[vertex[2]].append(position)
-                    triangle.append(position)
-                else:
-                    triangle.append(vertex_esists[0])
-            triangles.append(model_util.Triangle(triangle[0], triangle[1], triangle[2]))
-        positions = []
-        for positions_value in positions_dict.values():
-            positions.extend(positions_value)
-        return model_util.MonocoqueShell(positions, triangles)
-
-def load_submodule(path, force_load_merged_stl, vertex_matching=True):
+            sha.update(read_block)
+    return sha.hexdigest()
+
+def fetch_content_hash(path, cache_dir):
+    # the content hash is reused while the path, size and mtime are unchanged
+    stat = os.stat(path)
+    path_hash = hashlib.sha256(os.path.abspath(path).encode()).hexdigest()
+    record = JsonLoader(os.path.join(cache_dir, path_hash + ".json"))
+    if os.path.isfile(record.file):
+        try:
+            cached = record.fetch()
+            if cached['size'] == stat.st_size and cached['mtime_ns'] == stat.st_mtime_ns:
+                return cached['hash']
+        except (ValueError, KeyError, TypeError):
+            pass # broken record, hash again
+    record.dictionary = {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'hash': calc_file_hash(path)}
+    record.dump()
+    return record.dictionary['hash']
+
+def save_npy(file, array):
+    # written to a temporary file first, the other process never maps a half written cache
+    temp_file = "%s.%d.tmp" % (file, os.getpid())
+    with open(temp_file, "wb") as f:
+        np.save(f, array)
+    os.replace(temp_file, file)
+
+def load_weld_cache(path, vertex_matching, weld_cache, tolerance=0.):
+    cache_dir = fetch_weld_cache_dir(path, weld_cache)
+    os.makedirs(cache_dir, exist_ok=True)
+    key = fetch_content_hash(path, cache_dir) + ("_matched" if vertex_matching else "_separated")
+    if vertex_matching and 0. < tolerance:
+        key += "_%r" % float(tolerance)
+    vertexes_file = os.path.join(cache_dir, key + ".vertexes.npy")
+    faces_file = os.path.join(cache_dir, key + ".faces.npy")
+    if not os.path.isfile(vertexes_file) or not os.path.isfile(faces_file):
+        array_shell = convert_vertexes_to_array_monocoque_shell(read_binary_stl_vertexes(path), vertex_matching, tolerance)
+        save_npy(vertexes_file, array_shell.vertexes)
+        save_npy(faces_file, array_shell.faces)
+    # copy-on-write, deformation does not modify the cache
+    return model_util.ArrayMonocoqueShell(
+        np.load(vertexes_file, mmap_mode='c'),
+        np.load(faces_file, mmap_mode='c'))
+
+@dataclass
+class MappedBinaryStl:
+    path:str
+    records:np.ndarray = field(default=None)
+    chunk_size:int = field(default=1 << 20) # triangles per reduction step
+
+    def __post_init__(self):
+        count = max(0, (os.path.getsize(self.path) - stl_binary_header_size) // model_util.stl_binary_record_dtype.itemsize)
+        if 0 == count:
+            self.records = np.zeros(0, dtype=model_util.stl_binary_record_dtype)
+        else:
+            self.records = np.memmap(self.path, dtype=model_util.stl_binary_record_dtype,
+                mode='r', offset=stl_binary_header_size, shape=(count,))
+
+    def count_triangles(self):
+        return len(self.records)
+
+    def triangle_vertexes(self, start=0, stop=None):
+        # zero-copy view, shape: (number of triangles, 3, 3), float32
+        return self.records['vertexes'][start:stop]
+
+    def area(self):
+        # ((x_min, x_max), (y_min, y_max), (z_min, z_max)), None if empty
+        if 0 == self.count_triangles():
+            return None
+        mins = []
+        maxs = []
+        for start in range(0, self.count_triangles(), self.chunk_size):
+            vertexes = self.triangle_vertexes(start, start + self.chunk_size)
+            mins.append(vertexes.min(axis=(0, 1)))
+            maxs.append(vertexes.max(axis=(0, 1)))
+        mins = np.min(mins, axis=0).astype(np.float64)
+        maxs = np.max(maxs, axis=0).astype(np.float64)
+        return tuple((float(mins[i]), float(maxs[i])) for i in range(3))
+
+    def z_range(self):
+        area = self.area()
+        return None if area is None else area[2]
+
+    def fetch_triangle_indexes_in_z_range(self, z_min, z_max):
+        indexes = []
+        for start in range(0, self.count_triangles(), self.chunk_size):
+            z = self.triangle_vertexes(start, start + self.chunk_size)[:, :, 2]
+            overlapped = (z.min(axis=1) <= z_max) & (z_min <= z.max(axis=1))
+            indexes.append(np.nonzero(overlapped)[0] + start)
+        if 0 == len(indexes):
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate(indexes)
+
+    def fetch_triangle_vertexes_in_z_range(self, z_min, z_max):
+        return self.records['vertexes'][self.fetch_triangle_indexes_in_z_range(z_min, z_max)]
+
+    def array_monocoque_shell(self, vertex_matching=True, tolerance=0.):
+        return convert_vertexes_to_array_monocoque_shell(self.triangle_vertexes(), vertex_matching, tolerance)
+
+    def monocoque_shell(self, vertex_matching=True, tolerance=0.):
+        return convert_vertexes_to_monocoque_shell(self.triangle_vertexes(), vertex_matching, tolerance)
+
+def map_binary_stl(path):
+    return MappedBinaryStl(path)
+
+area_sidecar_extension = ".area.json"
+
+def load_binary_stl_area(path, use_sidecar=False):
+    # return: ((x_min, x_max), (y_min, y_max), (z_min, z_max)), None if empty
+    stat = os.stat(path)
+    sidecar = JsonLoader(path + area_sidecar_extension)
+    if use_sidecar and os.path.isfile(sidecar.file):
+        try:
+            cached = sidecar.fetch()
+            if cached['size'] == stat.st_size and cached['mtime_ns'] == stat.st_mtime_ns:
+                return None if cached['area'] is None else tuple(tuple(axis) for axis in cached['area'])
+        except (ValueError, KeyError, TypeError):
+            pass # broken sidecar, scan again
+    area = map_binary_stl(path).area()
+    if use_sidecar:
+        sidecar.dictionary = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'area': area}
+        sidecar.dump()
+    return area
+
+def load_huge_binary_stl(path, tolerance=0.):
+    return map_binary_stl(path).monocoque_shell(tolerance=tolerance)
+
+def load_binary_stl_files(paths, vertex_matching=True, workers=1, weld_cache=None):
+    # workers: number of processes, None: number of cpus, 1: load in this process
+    # the order of the returned shells is the same as paths
+    if 1 == workers or len(paths) <= 1:
+        return [load_binary_stl(path, vertex_matching, weld_cache) for path in paths]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        array_shells = list(executor.map(load_binary_stl_array, paths, [vertex_matching] * len(paths), [weld_cache] * len(paths)))
+    return [array_shell.to_monocoque_shell() for array_shell in array_shells]
+
+def fetch_divided_stl_files(path):
+    stl_divided_folder_full_path_name = os.path.join(path, "divided")
+    if not os.path.exists(stl_divided_folder_full_path_name):
+        return []
+    return sorted(glob.glob(os.path.join(stl_divided_folder_full_path_name, "*.stl")))
+
+submodule_build_record_file_name = ".build.json"
+
+def fetch_submodule_script(path):
+    file_name = os.path.basename(os.path.normpath(path))
+    return os.path.join(path, file_name + ".py")
+
+def fetch_submodule_merged_stl(path):
+    file_name = os.path.basename(os.path.normpath(path))
+    return os.path.join(path, file_name + ".stl")
+
+def fetch_submodule_dependencies(path):
+    # submodules placed in the submodule directory: path/<name>/<name>.py or path/<name>/<name>.stl
+    dependencies = []
+    for name in sorted(os.listdir(path)):
+        dependency = os.path.join(path, name)
+        if not os.path.isdir(dependency) or "divided" == name:
+            continue
+        if os.path.isfile(fetch_submodule_script(dependency)) or os.path.isfile(fetch_submodule_merged_stl(dependency)):
+            dependencies.append(dependency)
+    return dependencies
+
+def calc_submodule_hash(path):
+    sha = hashlib.sha256()
+    script = fetch_submodule_script(path)
+    if os.path.isfile(script):
+        with open(script, "rb") as f:
+            sha.update(f.read())
+    else:
+        # prebuilt stl only, its content is identified by size and mtime
+        stat = os.stat(fetch_submodule_merged_stl(path))
+        sha.update(("%d:%d" % (stat.st_size, stat.st_mtime_ns)).encode())
+    for dependency in fetch_submodule_dependencies(path):
+        sha.update(os.path.basename(dependency).encode())
+        sha.update(calc_submodule_hash(dependency).encode())
+    return sha.hexdigest()
+
+def is_submodule_built(path):
+    return os.path.exists(fetch_submodule_merged_stl(path)) or 0 != len(fetch_divided_stl_files(path))
+
+def is_submodule_stale(path):
+    if not os.path.isfile(fetch_submodule_script(path)):
+        return False # nothing to build
+    if not is_submodule_built(path):
+        return True
+    record = JsonLoader(os.path.join(path, submodule_build_record_file_name))
+    if not os.path.isfile(record.file):
+        return True
+    try:
+        return record.fetch()['hash'] != calc_submodule_hash(path)
+    except (ValueError, KeyError, TypeError):
+        return True
+
+def build_submodule(path, workers=1):
+    # dependencies first, stale dependencies are built in parallel if workers != 1
+    stale_dependencies = [x for x in fetch_submodule_dependencies(path) if is_submodule_stale(x)]
+    if 1 != workers and 1 < len(stale_dependencies):
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(build_submodule, stale_dependencies))
+    else:
+        for dependency in stale_dependencies:
+            build_submodule(dependency)
+
+    if not is_submodule_stale(path):
+        return False
+    # the script runs in its own interpreter, as "python <script>" in the current directory
+    result = subprocess.run([sys.executable, fetch_submodule_script(path)])
+    if 0 == result.returncode and is_submodule_built(path):
+        record = JsonLoader(os.path.join(path, submodule_build_record_file_name))
+        record.dictionary = {'hash': calc_submodule_hash(path)}
+        record.dump()
+    return True
+
+def load_submodule(path, force_load_merged_stl, vertex_matching=True, workers=1, weld_cache=None):
     if not os.path.isdir(path):
         raise Exception("submodule is not a path")
-    # load stl(case: already exists)
-    if not force_load_merged_stl:
-        stl_divided_folder_full_path_name = os.path.join(path, "divided")
-        stl_divided_files_full_path_names = []
-        if os.path.exists(stl_divided_folder_full_path_name):
-            stl_divided_files_full_path_names = glob.glob(os.path.join(stl_divided_folder_full_path_name, "*.stl"))
-        if 0 != len(stl_divided_files_full_path_names):
-            divided_shells = []
-            for stl_divided_files_full_path_name in stl_divided_files_full_path_names:
-                divided_shells.append(load_binary_stl(stl_divided_files_full_path_name, vertex_matching))
-            return divided_shells
+    # generating stl(case: not exists or the script is changed)
+    build_submodule(path, workers)
 
-    file_name = path.split(os.sep)[-1]
-    stl_file_full_path_name = os.path.join(path, file_name + ".stl")
-    if os.path.exists(stl_file_full_path_name):
-        return [load_binary_stl(stl_file_full_path_name, vertex_matching)]
-
-    # generating stl
-    py_file_full_path_name = os.path.join(path, file_name + ".py")
-    if os.path.exists(py_file_full_path_name):
-        subprocess.call('python %s' % py_file_full_path_name, shell=True)
-    
-    # load stl(case: generated now)
     if not force_load_merged_stl:
-        stl_divided_files_full_path_names = []
-        if os.path.exists(stl_divided_folder_full_path_name):
-            stl_divided_files_full_path_names = glob.glob(os.path.join(stl_divided_folder_full_path_name, "*.stl"))
+        stl_divided_files_full_path_names = fetch_divided_stl_files(path)
         if 0 != len(stl_divided_files_full_path_names):
-            divided_shells = []
-            for stl_divided_files_full_path_name in stl_divided_files_full_path_names:
-                divided_shells.append(load_binary_stl(stl_divided_files_full_path_name, vertex_matching))
-            return divided_shells
+            return load_binary_stl_files(stl_divided_files_full_path_names, vertex_matching, workers, weld_cache)
 
+    stl_file_full_path_name = fetch_submodule_merged_stl(path)
     if os.path.exists(stl_file_full_path_name):
-        return [load_binary_stl(stl_file_full_path_name, vertex_matching)]
+        return [load_binary_stl(stl_file_full_path_name, vertex_matching, weld_cache)]
 
     raise Exception("failed to create stl")
 
 def load_vertexes(path):
-    with open(path, "rb") as f:
-        read_block = f.read(80) # discard
-        read_block = f.read(4) # discard
-
-        format = "<ffffffffffffxx" # 32bit-float(4byte) * 3 * 4 + padding(1byte) * 2 = 50byte, little endian
-        size = struct.calcsize(format)
-
-        vertexes = []
-        unpacked = tuple()
-        while True:
-            read_block = f.read(size)
-            if len(read_block) != size:
-                break
-            unpacked = struct.unpack(format, read_block)
-            vertexes_loaded = [\
-                np.array([unpacked[3], unpacked[4], unpacked[5], 1.]),\
-                np.array([unpacked[6], unpacked[7], unpacked[8], 1.]),\
-                np.array([unpacked[9], unpacked[10], unpacked[11], 1.])]
-
-            for vertex in vertexes_loaded:
-                vertex_esists = [x for x in vertexes if x[0] == vertex[0] and x[1] == vertex[1] and x[2] == vertex[2]]
-                if (0 == len (vertex_esists)):
-                    vertexes.append(vertex)
-            
-        return vertexes
+    unique_vertexes, _ = weld_vertexes(read_binary_stl_vertexes(path))
+    extended_vertexes = np.ones((len(unique_vertexes), 4))
+    extended_vertexes[:, :3] = unique_vertexes
+    return list(extended_vertexes)
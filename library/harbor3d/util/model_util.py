@@ -7,6 +7,7 @@ from typing import List
 import struct
 
 from harbor3d.util import calc_util
+from harbor3d.util import export_util
 
 @dataclass
 class Facet:
@@ -29,15 +30,6 @@ class Facet:
             cross_product /= l2_norm
         self.normal = np.array([cross_product[0], cross_product[1], cross_product[2], 1.])
 
-    def write(self, f):
-        f.write(' facet normal {} {} {}\n'.format(self.normal[0], self.normal[1], self.normal[2]))
-        f.write('  outer loop\n')
-        f.write('   vertex {} {} {}\n'.format(self.vertex_1[0], self.vertex_1[1], self.vertex_1[2]))
-        f.write('   vertex {} {} {}\n'.format(self.vertex_2[0], self.vertex_2[1], self.vertex_2[2]))
-        f.write('   vertex {} {} {}\n'.format(self.vertex_3[0], self.vertex_3[1], self.vertex_3[2]))
-        f.write('  endloop\n')
-        f.write(' endfacet\n')
-    
     def write_binary(self, f):
         f.write(struct.pack('<fff', self.normal[0], self.normal[1], self.normal[2]))
         f.write(struct.pack('<fff', self.vertex_1[0], self.vertex_1[1], self.vertex_1[2]))
@@ -254,22 +246,6 @@ class Triangle:
     
     def get_positions(self):
         return [self.vertex_1, self.vertex_2, self.vertex_3]
-    
-    def write_stl(self, keel, f):
-        if self.vertex_1 is None or self.vertex_2 is None or self.vertex_3 is None:
-            return
-        facet = Facet(self.vertex_1.position, self.vertex_2.position, self.vertex_3.position)
-        facet.translation(np.dot(keel.relative_translation, keel.origin_translation))
-        facet.calc_normal()
-        facet.write(f)
-    
-    def write_stl_binary(self, keel, f):
-        if self.vertex_1 is None or self.vertex_2 is None or self.vertex_3 is None:
-            return
-        facet = Facet(self.vertex_1.position, self.vertex_2.position, self.vertex_3.position)
-        facet.translation(np.dot(keel.relative_translation, keel.origin_translation))
-        facet.calc_normal()
-        facet.write_binary(f)
 
 @dataclass
 class MonocoqueShell:
@@ -284,13 +260,53 @@ class MonocoqueShell:
         for position in self.positions:
             position.copy_translated_to_default()
     
-    def write_stl(self, keel, f):
-        for triangle in self.triangles:
-            triangle.write_stl(keel, f)
+    def write_stl(self, keel, f, precision=None):
+        write_stl_triangle_vertexes(
+            self.triangle_vertexes(keel.world_translation()), f, precision)
     
-    def write_stl_binary(self, keel, f):
+    def stl_binary_records(self, keel):
+        return generate_stl_binary_records(
+            self.triangle_vertexes(keel.world_translation()))
+
+    def triangle_vertexes(self, translation):
+        # shape: (number of triangles, 3, 3), translated with one matrix product
+        indexes = dict() # key: id(Position), value: index of extended_vertexes
+        extended_vertexes = []
+        faces = []
         for triangle in self.triangles:
-            triangle.write_stl_binary(keel, f)
+            if triangle.vertex_1 is None or triangle.vertex_2 is None or triangle.vertex_3 is None:
+                continue
+            face = []
+            for position in (triangle.vertex_1, triangle.vertex_2, triangle.vertex_3):
+                index = indexes.get(id(position))
+                if index is None:
+                    index = indexes[id(position)] = len(extended_vertexes)
+                    extended_vertexes.append(position.position)
+                face.append(index)
+            faces.append(face)
+        if 0 == len(faces):
+            return np.zeros((0, 3, 3))
+        translated_vertexes = np.dot(np.array(extended_vertexes, dtype=np.float64), translation)[:, :3]
+        return translated_vertexes[np.array(faces, dtype=np.int32)]
+
+    def count_triangles(self):
+        return len(self.triangles)
+
+    def deform(self, deformation_fanc):
+        for position in self.positions:
+            pos = position.position
+            new_x_y_z = deformation_fanc(pos[0], pos[1], pos[2])
+            if None != new_x_y_z:
+                pos[0] = new_x_y_z[0]
+                pos[1] = new_x_y_z[1]
+                pos[2] = new_x_y_z[2]
+
+    def max_z_position(self):
+        max_z_position = 0.
+        for position in self.positions:
+            if max_z_position < position.position[2]:
+                max_z_position = position.position[2]
+        return max_z_position
 
     def generate_line_segments(self):
         if 0 == len(self.triangles):
@@ -330,6 +346,125 @@ class MonocoqueShell:
                 line_segments[-1].belong_to.append(triangle)
         return line_segments
 
+@dataclass
+class ArrayMonocoqueShell:
+    # vertexes: (N, 3), faces: (M, 3) indexes of vertexes
+    vertexes:np.ndarray = field(default_factory=lambda: np.zeros((0, 3)))
+    faces:np.ndarray = field(default_factory=lambda: np.zeros((0, 3), dtype=np.int32))
+
+    @staticmethod
+    def from_monocoque_shell(monocoque_shell):
+        indexes = dict() # key: id(Position), value: index of vertexes
+        vertexes = []
+        for position in monocoque_shell.positions:
+            if id(position) in indexes:
+                continue
+            indexes[id(position)] = len(vertexes)
+            vertexes.append(position.position[:3])
+        faces = []
+        for triangle in monocoque_shell.triangles:
+            if triangle.vertex_1 is None or triangle.vertex_2 is None or triangle.vertex_3 is None:
+                continue
+            face = []
+            for position in triangle.get_positions():
+                if not id(position) in indexes:
+                    indexes[id(position)] = len(vertexes)
+                    vertexes.append(position.position[:3])
+                face.append(indexes[id(position)])
+            faces.append(face)
+        return ArrayMonocoqueShell(
+            np.array(vertexes, dtype=np.float64).reshape(-1, 3),
+            np.array(faces, dtype=np.int32).reshape(-1, 3))
+
+    def to_monocoque_shell(self):
+        extended_vertexes = np.ones((len(self.vertexes), 4))
+        extended_vertexes[:, :3] = self.vertexes
+        positions = [Position(vertex) for vertex in extended_vertexes]
+        triangles = [Triangle(positions[i1], positions[i2], positions[i3]) for i1, i2, i3 in self.faces.tolist()]
+        return MonocoqueShell(positions, triangles)
+
+    def translated_vertexes(self, translation):
+        extended_vertexes = np.ones((len(self.vertexes), 4))
+        extended_vertexes[:, :3] = self.vertexes
+        return np.dot(extended_vertexes, translation)[:, :3]
+
+    def triangle_vertexes(self, translation):
+        # shape: (number of triangles, 3, 3)
+        return self.translated_vertexes(translation)[self.faces]
+
+    def write_stl(self, keel, f, precision=None):
+        write_stl_triangle_vertexes(
+            self.triangle_vertexes(keel.world_translation()), f, precision)
+
+    def stl_binary_records(self, keel):
+        return generate_stl_binary_records(
+            self.triangle_vertexes(keel.world_translation()))
+
+    def count_triangles(self):
+        return len(self.faces)
+
+    def deform(self, deformation_fanc):
+        for index, (x, y, z) in enumerate(self.vertexes.tolist()):
+            new_x_y_z = deformation_fanc(x, y, z)
+            if None != new_x_y_z:
+                self.vertexes[index] = new_x_y_z[:3]
+
+    def max_z_position(self):
+        if 0 == len(self.vertexes):
+            return 0.
+        return max(0., float(self.vertexes[:, 2].max()))
+
+# 32bit-float(4byte) * 3 * 4 + uint16(2byte) = 50byte, little endian
+stl_binary_record_dtype = np.dtype([
+    ('normal', '<f4', (3,)),
+    ('vertexes', '<f4', (3, 3)),
+    ('attribute', '<u2')])
+
+def calc_normals(triangle_vertexes):
+    cross_products = np.cross(
+        triangle_vertexes[:, 1] - triangle_vertexes[:, 0],
+        triangle_vertexes[:, 2] - triangle_vertexes[:, 0])
+    l2_norms = np.linalg.norm(cross_products, ord=2, axis=1)
+    nonzero = l2_norms > 0. # same as Facet.calc_normal
+    cross_products[nonzero] /= l2_norms[nonzero, np.newaxis]
+    return cross_products
+
+def generate_stl_binary_records(triangle_vertexes):
+    records = np.zeros(len(triangle_vertexes), dtype=stl_binary_record_dtype)
+    records['normal'] = calc_normals(triangle_vertexes)
+    records['vertexes'] = triangle_vertexes
+    return records
+
+def stl_facet_format(precision=None):
+    # precision: see export_util.value_format
+    value_format = export_util.value_format(precision)
+    return (' facet normal {0} {0} {0}\n'
+        '  outer loop\n'
+        '   vertex {0} {0} {0}\n'
+        '   vertex {0} {0} {0}\n'
+        '   vertex {0} {0} {0}\n'
+        '  endloop\n'
+        ' endfacet\n').format(value_format)
+
+def write_stl_triangle_vertexes(triangle_vertexes, f, precision=None, chunk_size=8192):
+    facet_format = stl_facet_format(precision)
+    for start in range(0, len(triangle_vertexes), chunk_size):
+        chunk = triangle_vertexes[start:start+chunk_size]
+        values = np.concatenate([calc_normals(chunk), chunk.reshape(-1, 9)], axis=1)
+        f.write(''.join([facet_format % tuple(row) for row in values.tolist()]))
+
+def write_stl_binary_header(f, count=0):
+    # 80Byte padding + uint32 number of triangles
+    f.write(bytes(80))
+    f.write(struct.pack("<L", count))
+
+def patch_stl_binary_triangle_count(f, header_position, count):
+    # f: seekable, the header was written at header_position
+    end_position = f.tell()
+    f.seek(header_position + 80)
+    f.write(struct.pack("<L", count))
+    f.seek(end_position)
+
 @dataclass
 class LineSegment:
     end1:Position = field(default=None)
@@ -0,0 +1,40 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from harbor3d.util import model_util
+from harbor3d.util.concat_util import ConcatConfig, ShellData, calc_penetration_y_axis_pararell_array
+
+def write_binary_stl(path, triangle_vertexes):
+    with open(path, "wb") as f:
+        model_util.write_stl_binary_header(f, len(triangle_vertexes))
+        f.write(model_util.generate_stl_binary_records(triangle_vertexes).tobytes())
+
+class TestScanPenetrations(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        # one triangle crossing z = 0 at x: -0.5 ~ 14.5
+        self.triangle_vertexes = np.array([[[-1., -1., -1.], [15., 1., -1.], [7., 0., 15.]]])
+        self.path = os.path.join(self.temp_dir.name, "triangle.stl")
+        write_binary_stl(self.path, self.triangle_vertexes)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_unsorted_rays(self):
+        # retry rays are collected in the order of the first penetrations, not in x order
+        shell = ShellData(ConcatConfig(1., 1.), self.path)
+        penetrations = shell.scan_penetrations({0: [5, 13, -5, -3]}, 0.5, 0.)
+        self.assertEqual(sorted(penetrations.keys()), [(0, 5), (0, 13)])
+        penetrations_sorted = shell.scan_penetrations({0: [-5, -3, 5, 13]}, 0.5, 0.)
+        self.assertEqual(penetrations, penetrations_sorted)
+
+    def test_array_penetrations(self):
+        x_scans = np.array([-2.5, -1.5, 5.5, 13.5])
+        ray_indexes, _ = calc_penetration_y_axis_pararell_array(self.triangle_vertexes, x_scans, 0., -2., 4.)
+        self.assertEqual(ray_indexes.tolist(), [2, 3])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import unittest
+
+import numpy as np
+
+from harbor3d import Dock, Shipwright
+
+class TestNameIndex(unittest.TestCase):
+    def test_duplicate_names(self):
+        sw = Shipwright(Dock())
+        a = sw.void(1.)
+        b = sw.void(1.)
+        sw.set_name(a, 'arm')
+        self.assertEqual(sw.fetch_by_name('arm'), [a])
+        b.name = 'arm'
+        fetched = sw.fetch_by_name('arm')
+        self.assertEqual(len(fetched), 2)
+        self.assertIs(fetched[0], a)
+        self.assertIs(fetched[1], b)
+        a.name = 'leg'
+        self.assertEqual(len(sw.fetch_by_name('arm')), 1)
+        self.assertIs(sw.fetch_by_name('arm')[0], b)
+        self.assertIs(sw.fetch_by_name('leg')[0], a)
+
+    def test_order_of_ships(self):
+        sw = Shipwright(Dock())
+        root = sw.void(1.)
+        child = sw.parent(root).void(1.)
+        child.name = 'x'
+        root.name = 'x'
+        fetched = sw.fetch_by_name('x')
+        self.assertIs(fetched[0], root)
+        self.assertIs(fetched[1], child)
+
+class TestChildrenIndex(unittest.TestCase):
+    def check_rotated_child(self, attach):
+        sw = Shipwright(Dock())
+        parent = sw.void(1.)
+        child = sw.void(1.)
+        attach(parent, child)
+        sw.dock.sanitize_dock()
+        sw.dock.rotate_keel(parent, np.pi/2)
+        sw.dock.sanitize_dock()
+        np.testing.assert_allclose(np.dot(np.array([0., 0., 0., 1.]), child.keel.world_translation()), [1., 0., 0., 1.], atol=1e-12)
+        self.assertEqual(sw.dock.get_child_ship(parent), [child])
+
+    def test_ship_set_parent(self):
+        self.check_rotated_child(lambda parent, child: child.set_parent(parent))
+
+    def test_parent_assignment(self):
+        self.check_rotated_child(lambda parent, child: setattr(child, 'parent', parent))
+
+    def test_reparent(self):
+        sw = Shipwright(Dock())
+        parent_1 = sw.void(1.)
+        parent_2 = sw.void(2.)
+        child = sw.parent(parent_1).void(1.)
+        child.set_parent(parent_2)
+        self.assertEqual(sw.dock.get_child_ship(parent_1), [])
+        self.assertEqual(sw.dock.get_child_ship(parent_2), [child])
+
+if __name__ == '__main__':
+    unittest.main()
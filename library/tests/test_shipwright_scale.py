@@ -0,0 +1,86 @@
+import unittest
+
+import numpy as np
+
+from harbor3d import Dock, Shipwright
+
+# move and rotate helpers as chains of void ships, as they were built before transform nodes
+def void_chain_move_x(sw, x):
+    if x > 0.:
+        void_1 = sw.rotate(np.pi/2.).void(x)
+        return sw.rotate(-np.pi/2.).parent(void_1).void()
+    else:
+        void_1 = sw.rotate(-np.pi/2.).void(abs(x))
+        return sw.rotate(np.pi/2.).parent(void_1).void()
+
+def void_chain_move_y(sw, y):
+    if y > 0.:
+        void_1 = sw.rotate(np.pi/2., np.pi/2.).void(y)
+        void_2 = sw.rotate(-np.pi/2.).parent(void_1).void()
+        return sw.rotate(0., -np.pi/2.).parent(void_2).void()
+    else:
+        void_1 = sw.rotate(-np.pi/2., np.pi/2.).void(abs(y))
+        void_2 = sw.rotate(np.pi/2.).parent(void_1).void()
+        return sw.rotate(0., -np.pi/2.).parent(void_2).void()
+
+def void_chain_move_xy(sw, x, y):
+    move_1 = void_chain_move_x(sw, x)
+    return void_chain_move_y(sw.parent(move_1), y)
+
+def void_chain_move_z_back(sw, back_z):
+    rotate_1 = sw.parent(sw.void()).rotate(np.pi).void(back_z)
+    return sw.rotate(np.pi).parent(rotate_1).void()
+
+def void_chain_rotate_x(sw, rad_x):
+    rotate_1 = sw.rotate(rad_x, -np.pi/2).void()
+    return sw.rotate(0., np.pi/2).parent(rotate_1).void()
+
+def void_chain_rotate_bone_xyz_euler(sw, x, y, z):
+    rotate_1 = sw.rotate(-z).void()
+    rotate_2 = sw.parent(rotate_1).rotate(0., y).void()
+    return void_chain_rotate_x(sw.parent(rotate_2), x)
+
+def build_rig(void_chain, length_scale=1.):
+    sw = Shipwright(Dock())
+    root = sw.void(1.)
+    if void_chain:
+        move = void_chain_move_x(sw.parent(root), 3.*length_scale)
+        cube = sw.parent(move).cube(1.*length_scale)
+        back = void_chain_move_z_back(sw.parent(cube), 2.*length_scale)
+        rotate = void_chain_rotate_x(sw.parent(back), 0.3)
+        bone = void_chain_rotate_bone_xyz_euler(sw.parent(rotate), 0.2, -0.4, 0.7)
+        move = void_chain_move_xy(sw.parent(bone), 1.5*length_scale, -2.5*length_scale)
+    else:
+        move = sw.parent(root).move_x(3.)
+        cube = sw.parent(move).cube(1.*length_scale)
+        back = sw.parent(cube).move_z_back(2.)
+        rotate = sw.parent(back).rotate_x(0.3)
+        bone = sw.parent(rotate).rotate_bone_xyz_euler(0.2, -0.4, 0.7)
+        move = sw.parent(bone).move_xy(1.5, -2.5)
+    child = sw.parent(move).void(2.*length_scale)
+    return sw, root, cube, child
+
+class TestScale(unittest.TestCase):
+    def test_scale_moves_like_void_chain(self):
+        for scale in [1., 2., 0.5]:
+            # expected: void chains built with the scaled lengths
+            sw, root, cube, child = build_rig(True, scale)
+            sw.dock.sanitize_dock()
+            expected = [cube.keel.world_translation(), child.keel.world_translation(), child.keel.translation(1.)]
+            for void_chain in [True, False]:
+                sw, root, cube, child = build_rig(void_chain)
+                sw.dock.sanitize_dock()
+                sw.scale(scale, root)
+                sw.dock.sanitize_dock()
+                actual = [cube.keel.world_translation(), child.keel.world_translation(), child.keel.translation(1.)]
+                for expected_translation, actual_translation in zip(expected, actual):
+                    np.testing.assert_allclose(actual_translation, expected_translation, atol=1e-12)
+
+    def test_scale_cube_origin(self):
+        sw, root, cube, _ = build_rig(False)
+        sw.scale(2., root)
+        sw.dock.sanitize_dock()
+        np.testing.assert_allclose(cube.keel.world_translation()[3, :3], [6., 0., 1.], atol=1e-12)
+
+if __name__ == '__main__':
+    unittest.main()